@@ -0,0 +1,300 @@
+""" Benchmark the OCR backends on labelled Table A drawings
+
+Drawings already renamed to LOR-SEQ.png (processed/ or meta/) act as
+the labelled set, the LOR code and sequence are compared against the
+fields each backend recovers.
+
+With --synthetic N the whole pipeline (rip, data_extract, geotag) is run
+in a temporary directory over N generated drawings instead, reporting
+throughput, latency percentiles and field accuracy for each stage.
+Adding --sweep runs only the data_extract table extraction, once per
+preprocessing setting in SWEEP, to show the speed/accuracy trade-off.
+The downscaling settings are given as a scale of the synthetic DPI.
+"""
+
+# pylint: disable=C0415
+
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+from typing import Dict, List, Union
+
+import rip
+import preprocess
+from instrument import report
+from ocr_backend import BACKENDS
+
+FOLDERS = [rip.PROCESSED, 'meta']
+SWEEP = {
+    'full page': None,
+    'crop': {'deskew': False, 'binarise': False},
+    'crop, binarise': {'deskew': False},
+    'crop, binarise, deskew': {},
+    '0.75 scale': {'scale': 0.75},
+    '0.5 scale': {'scale': 0.5},
+    '0.35 scale': {'scale': 0.35}
+}
+
+def sweep_settings(options: dict, source_dpi: int) -> Union[preprocess.Settings, None]:
+    """ Returns the preprocessing settings for a SWEEP entry, downscaling
+    by its scale of the source DPI """
+    if options is None:
+        return None
+    options = dict(options)
+    dpi = round(source_dpi * options.pop('scale', 1.0))
+    return preprocess.Settings(dpi=dpi, source_dpi=source_dpi, **options)
+
+def load_samples(folders: List[str], limit: int) -> List[tuple]:
+    """ Returns (path, lor, seq) for the labelled drawings """
+    samples = []
+    for folder in folders:
+        path = os.path.join(rip.WORKDIR, folder)
+        if not os.path.isdir(path):
+            continue
+        for file_name in sorted(os.listdir(path)):
+            if not file_name.endswith('.png') or file_name.count('-') != 1:
+                continue
+            lor, seq = file_name[:-4].split('-')
+            samples.append((os.path.join(path, file_name), lor, seq))
+    return samples[:limit] if limit else samples
+
+def run_backend(backend: str, samples: List[tuple], roi: bool = False) -> dict:
+    """ Time the backend over the samples and score the recovered fields """
+    rip.BACKEND = backend
+    rip.USE_CACHE = False
+
+    start = time.perf_counter()
+    rip.get_reader()
+    load_time = time.perf_counter() - start
+
+    latencies = []
+    correct = {'lor': 0, 'seq': 0, 'date': 0}
+    for full_path, lor, seq in samples:
+        start = time.perf_counter()
+        values = rip.read_image(full_path, roi)
+        latencies.append(time.perf_counter() - start)
+
+        found = rip.get_lor(values)
+        correct['lor'] += bool(found) and found.replace('O', '0') == lor
+        found = rip.get_seq(values)
+        correct['seq'] += bool(found) and found.replace('O', '0') == seq
+        correct['date'] += rip.get_updated_date(values) != rip.DEFAULT_DATE
+
+    total = sum(latencies)
+    count = len(samples) or 1
+    return {
+        'backend': backend,
+        'roi': roi,
+        'images': len(samples),
+        'load_seconds': round(load_time, 3),
+        'images_per_second': round(len(samples) / total, 3) if total else 0.0,
+        **{f'{field}_accuracy': round(value / count, 3) for field, value in correct.items()}
+    }
+
+def read_rows(path: str) -> List[List[str]]:
+    """ Returns the rows of a stage output TSV """
+    if not os.path.isfile(path):
+        return []
+    with open(path, encoding='utf-8') as file:
+        return [line.rstrip('\n').split('\t') for line in file]
+
+def write_corrected(source: str, target: str, elrs: List[str]) -> None:
+    """ Stand in for the interactive update_failed step: keep the complete rows with a known ELR """
+    with open(target, 'w', encoding='utf-8') as file:
+        for row in read_rows(source):
+            if 'Undefined' not in row and row[3] in elrs:
+                file.write('\t'.join(row) + '\n')
+
+def stage_result(stage: str, images: int, latency: str = None) -> dict:
+    """ Throughput for a stage from the run report, with the latency
+    percentiles of the per image stage where given """
+    seconds = report.stages.get(stage, {}).get('seconds', 0.0)
+    result = {
+        'seconds': round(seconds, 3),
+        'images_per_second': round(images / seconds, 3) if seconds else 0.0
+    }
+    if latency:
+        result['latency'] = report.percentiles(latency)
+    return result
+
+def score_pipeline(truth: Dict[str, tuple], elrs: List[str]) -> dict:
+    """ Score the outputs in the working directory against the ground truth """
+    import data_extract
+    import geotag
+
+    named = set()
+    for folder in [data_extract.META, data_extract.FAILED, rip.PROCESSED]:
+        if os.path.isdir(folder):
+            named.update(os.listdir(folder))
+
+    correct = {'elr': 0, 'mileage': 0, 'description': 0}
+    for row in read_rows(data_extract.TSV):
+        drawing = truth.get(row[0])
+        if not drawing:
+            continue
+        correct['elr'] += row[3] == drawing.elr
+        correct['mileage'] += row[4:6] == [str(drawing.miles), f'{drawing.chains:02d}']
+        correct['description'] += row[7] == drawing.route
+
+    tagged = read_rows(geotag.TAGGED)
+    count = len(truth) or 1
+    return {
+        'rip': {'name_accuracy': round(len(named & set(truth)) / count, 3)},
+        'data_extract': {
+            f'{field}_accuracy': round(value / count, 3) for field, value in correct.items()
+        },
+        'geotag': {
+            'tagged': len(tagged),
+            'mean_err_yards': round(sum(float(row[-1]) for row in tagged) / len(tagged), 1)
+            if tagged else None
+        },
+        'unknown_elrs': sorted({row[3] for row in read_rows(data_extract.TSV)} - set(elrs))
+    }
+
+def run_pipeline(backend: str, count: int, seed: int = 0, use_text_layer: bool = False) -> dict:
+    """ Run every stage over synthetic drawings in a temporary directory,
+    with use_text_layer the PDF carries a text layer and rip reads it first """
+    import data_extract
+    import geotag
+    import synthetic
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as folder:
+        drawings = synthetic.generate(folder, count, seed, use_text_layer)
+        truth = {rip.format_filename(drawing): drawing for drawing in drawings}
+        report.reset()
+        # The reader, OCR cache and hash index of a previous backend are
+        # bound to its reader and to files in its deleted directory
+        rip.get_cache.cache_clear()
+        rip.get_hashes.cache_clear()
+        data_extract.get_reader.cache_clear()
+        os.chdir(folder)
+        try:
+            rip_args = [
+                '--workers', '1', '--batch-size', '1', '--backend', backend,
+                '--no-cache', '--no-dedupe'
+            ]
+            rip.main(rip_args + (['--text-layer'] if use_text_layer else []))
+            extract_backend = backend if backend in data_extract.BACKENDS else data_extract.BACKEND
+            data_extract.main(['--workers', '1', '--backend', extract_backend])
+            write_corrected(data_extract.TSV, geotag.CORRECTED, synthetic.ELRS)
+            geotag.main([])
+            scores = score_pipeline(truth, synthetic.ELRS)
+        finally:
+            os.chdir(cwd)
+
+    tagged = scores['geotag']['tagged']
+    return {
+        'backend': backend,
+        'images': count,
+        'seed': seed,
+        'text_layer': use_text_layer,
+        'rip': {
+            'extract': stage_result('strip_images', count),
+            'rename': stage_result(
+                'stream_images' if use_text_layer else 'rename_images', count, 'ocr'
+            ),
+            'text_layer_records': report.counters['text_layer_records'],
+            **scores['rip']
+        },
+        'data_extract': {
+            **stage_result('multiple_run', count, 'extract_tables'),
+            **scores['data_extract']
+        },
+        'geotag': {
+            'match': stage_result('match_to_mp', tagged),
+            'tag': stage_result('tag_images', tagged),
+            **scores['geotag']
+        },
+        'unknown_elrs': scores['unknown_elrs']
+    }
+
+def run_sweep(count: int, seed: int = 0, skew: float = 1.0) -> List[dict]:
+    """ Time and score the table extraction for each SWEEP setting over
+    synthetic drawings rotated by up to skew degrees """
+    import data_extract
+    import synthetic
+
+    rng = random.Random(seed)
+    results = []
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as folder:
+        os.chdir(folder)
+        try:
+            drawings = {}
+            for drawing in synthetic.make_drawings(count, seed):
+                file_name = rip.format_filename(drawing)
+                synthetic.render(drawing, rng.uniform(-skew, skew)).save(file_name)
+                drawings[file_name] = drawing
+
+            for name, options in SWEEP.items():
+                settings = sweep_settings(options, synthetic.DPI)
+                data_extract.PREPROCESS = settings
+                report.reset()
+                correct = {'elr': 0, 'mileage': 0, 'description': 0}
+                for file_name, drawing in drawings.items():
+                    elr, mileages, description = data_extract.extract_record(file_name)
+                    mileage = mileages[0]
+                    correct['elr'] += elr[0] == drawing.elr
+                    correct['mileage'] += bool(mileage) and (
+                        (mileage.miles, mileage.chains)
+                        == (str(drawing.miles), f'{drawing.chains:02d}')
+                    )
+                    correct['description'] += description == drawing.route
+                preprocess_seconds = report.stages.get('preprocess', {}).get('seconds', 0.0)
+                results.append({
+                    'settings': name,
+                    'dpi': settings.dpi if settings else synthetic.DPI,
+                    **stage_result('extract_tables', count, 'extract_tables'),
+                    'preprocess_seconds': round(preprocess_seconds, 3),
+                    **{
+                        f'{field}_accuracy': round(value / count, 3)
+                        for field, value in correct.items()
+                    }
+                })
+        finally:
+            os.chdir(cwd)
+    return results
+
+def main() -> None:
+    """ Entrypoint """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--backends', nargs='+', choices=BACKENDS, default=BACKENDS)
+    parser.add_argument('--limit', type=int, default=0, help='maximum drawings to OCR')
+    parser.add_argument('--roi', action='store_true', help='OCR the title block first')
+    parser.add_argument('--threads', type=int, default=rip.TORCH_THREADS)
+    parser.add_argument('--output', help='write the results as JSON')
+    parser.add_argument('--synthetic', type=int, metavar='N',
+                        help='run the whole pipeline over N generated drawings')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the generated drawings')
+    parser.add_argument('--text-layer', action='store_true',
+                        help='give the generated PDF a text layer and read it before OCR')
+    parser.add_argument('--sweep', action='store_true',
+                        help='with --synthetic, compare the data_extract preprocessing settings')
+    parser.add_argument('--skew', type=float, default=1.0,
+                        help='rotate the sweep drawings by up to this many degrees')
+    args = parser.parse_args()
+
+    rip.TORCH_THREADS = args.threads
+    if args.synthetic and args.sweep:
+        results = run_sweep(args.synthetic, args.seed, args.skew)
+    elif args.synthetic:
+        results = [
+            run_pipeline(backend, args.synthetic, args.seed, args.text_layer)
+            for backend in args.backends
+        ]
+    else:
+        samples = load_samples(FOLDERS, args.limit)
+        results = [run_backend(backend, samples, args.roi) for backend in args.backends]
+    for result in results:
+        print(result)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2)
+
+if __name__ == "__main__":
+    main()
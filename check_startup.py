@@ -0,0 +1,48 @@
+""" Measure module import and CLI --help times against a startup budget """
+
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from typing import List
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+BUDGET = 1.0
+MODULES = ['rip', 'data_extract', 'update_failed', 'geotag']
+CLIS = ['rip.py', 'data_extract.py']
+
+def timed_run(args: List[str], cwd: str) -> float:
+    """ Run the command in a fresh interpreter, returns the wall time """
+    env = {**os.environ, 'PYTHONPATH': REPO}
+    start = time.perf_counter()
+    subprocess.run(args, cwd=cwd, env=env, check=True, capture_output=True)
+    return time.perf_counter() - start
+
+def main() -> None:
+    """ Entrypoint """
+    failed = []
+    with tempfile.TemporaryDirectory() as cwd:
+        checks = [
+            (f'import {module}', [sys.executable, '-c', f'import {module}']) for module in MODULES
+        ]
+        checks += [
+            (f'{cli} --help', [sys.executable, os.path.join(REPO, cli), '--help']) for cli in CLIS
+        ]
+        for name, args in checks:
+            elapsed = timed_run(args, cwd)
+            status = 'OK' if elapsed <= BUDGET else 'OVER BUDGET'
+            print(f'{name:<25}{elapsed:>8.3f}s  {status}')
+            if elapsed > BUDGET:
+                failed.append(name)
+
+        created = os.listdir(cwd)
+        if created:
+            print(f'Import side effects in working directory: {created}')
+            failed.append('side effects')
+
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -3,15 +3,28 @@
 # pylint: disable=E0401, W0621
 
 import re
-from typing import List, Union
+import json
+from typing import List, Union, TYPE_CHECKING
 from collections import namedtuple
 import os
-from pandas import DataFrame
-
-from img2table.tables.objects.extraction import ExtractedTable
-from img2table.document import Image
-
-from easy_ocr import EasyOcrCustom
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+from contextlib import nullcontext
+from ocr_cache import OcrCache
+from ledger import Ledger, file_key
+import preprocess
+from ocr_backend import easyocr_kw, readtext_kw
+import record_writer
+from record_writer import RecordWriter, drop_files
+import instrument
+from instrument import report
+
+if TYPE_CHECKING:
+    from pandas import DataFrame
+    from img2table.tables.objects.extraction import ExtractedTable
+    from easy_ocr import EasyOcrCustom
 
 
 WORKDIR = '.'
@@ -26,19 +39,37 @@ MILEAGE_HEADER = re.compile('[M]?.[Ch]{?}')
 FILTERED_MILEAGE = re.compile(r'[\d\s]+')
 ELR = re.compile("[A-Z]{3}[0-9]?")
 TSV = os.path.join(WORKDIR, 'output.tsv')
+DELTA = os.path.join(WORKDIR, 'delta.json')
+# Each worker loads its own reader, on a GPU host its own CUDA context
+WORKERS = 1
+BACKENDS = ['easyocr', 'easyocr-cpu']
+BACKEND = 'easyocr'
+TORCH_THREADS = os.cpu_count() or 1
+PREPROCESS = None
 
 Mileage = namedtuple('Mileage', 'miles, chains, yards')
 Processed = []
 
-for path in [
-        os.path.join(WORKDIR, META),
-        os.path.join(WORKDIR, IMAGES),
-        os.path.join(WORKDIR, FAILED),
-    ]:
-    if not os.path.isdir(path):
-        os.mkdir(path)
-
-reader = EasyOcrCustom(lang=['en'])
+def setup_dirs() -> None:
+    """ Create the working directories where missing """
+    for path in [
+            os.path.join(WORKDIR, META),
+            os.path.join(WORKDIR, IMAGES),
+            os.path.join(WORKDIR, FAILED),
+        ]:
+        if not os.path.isdir(path):
+            os.mkdir(path)
+
+@lru_cache(maxsize=None)
+def get_reader() -> 'EasyOcrCustom':
+    """ Load the OCR reader on first use, importing torch is slow """
+    from easy_ocr import EasyOcrCustom  # pylint: disable=C0415
+    return EasyOcrCustom(
+        lang=['en'],
+        kw=easyocr_kw(BACKEND, TORCH_THREADS),
+        cache=OcrCache(),
+        options=readtext_kw(BACKEND)
+    )
 
 meta = {}
 
@@ -134,7 +165,7 @@ def parse_description(raw: str) -> Union[str, None]:
         raw = split[-1].strip()
     return raw.replace('\n', ' ')
 
-def generic_crawler(frame: DataFrame, search_str: str = 'Route') -> Union[str, None]:
+def generic_crawler(frame: 'DataFrame', search_str: str = 'Route') -> Union[str, None]:
     """ Returns corresponding column data when header matches """
     cols = list(frame)
     for i in cols:
@@ -145,15 +176,15 @@ def generic_crawler(frame: DataFrame, search_str: str = 'Route') -> Union[str, N
             return frame[i][1]
     return None
 
-def crawl_for_description(frame: DataFrame) -> str:
+def crawl_for_description(frame: 'DataFrame') -> str:
     """ Find and return the raw description data """
     return generic_crawler(frame, 'Route')
 
-def crawl_for_elr(frame: DataFrame) -> Union[str, None]:
+def crawl_for_elr(frame: 'DataFrame') -> Union[str, None]:
     """ Find and return the raw ELR data """
     return generic_crawler(frame, 'ELR')
 
-def crawl_for_mileage(data: DataFrame) -> Union[str, None]:
+def crawl_for_mileage(data: 'DataFrame') -> Union[str, None]:
     """ Find and return the raw mileage data """
     columns = list(data)
     for i in columns:
@@ -171,7 +202,7 @@ def crawl_for_mileage(data: DataFrame) -> Union[str, None]:
             return ret_val
     return None
 
-def extract_values(frame: DataFrame) -> dict:
+def extract_values(frame: 'DataFrame') -> dict:
     """ Extract the required raw values from the dataframe """
     return {
         'raw_desc': crawl_for_description(frame),
@@ -179,11 +210,14 @@ def extract_values(frame: DataFrame) -> dict:
         'raw_elr':crawl_for_elr(frame)
     }
 
-def parse_image(file: str) -> ExtractedTable:
-    """ Extract the data from the image """
-    doc = Image(file)
+def parse_image(file: str) -> 'ExtractedTable':
+    """ Extract the data from the image, preprocessed with the PREPROCESS settings """
+    from img2table.document import Image  # pylint: disable=C0415
+    with report.stage('preprocess'):
+        src = preprocess.prepare(file, PREPROCESS)
+    doc = Image(src)
     extracted_tables = doc.extract_tables(
-        ocr=reader,
+        ocr=get_reader(),
         implicit_rows=True,
         borderless_tables=True,
         min_confidence=50
@@ -204,19 +238,29 @@ def parse_elr(raw: str) -> Union[List[str], None]:
         return [None]
     return matches
 
-def update_csv(filename: str, elr: str, mileage: float, description: str):
+def update_csv(
+        filename: str,
+        elr: str,
+        mileage: float,
+        description: str,
+        writer: RecordWriter = None
+    ):
     """ Write the data to the csv file """
-    with open(TSV, 'a', encoding='utf-8') as file:
-        lor, seq = filename.split('-')
-        file.write(f'{filename}\t{lor}\t{seq.strip(".png")}\t{elr}\t{mileage}\t{description}\n')
+    lor, seq = filename.split('-')
+    row = (filename, lor, seq.strip(".png"), elr, mileage, description)
+    if writer:
+        writer.write(row)
+        return
+    with RecordWriter(TSV, columns=['file', 'lor', 'seq', 'elr', 'm', 'desc']) as single:
+        single.write(row)
 
-def write_to_csv(
+def make_row(
         filename: str,
         elr: List[Union[str, None]],
         mileage: List[Union[Mileage, None]],
         description: str
-    ):
-    """ Writes the data to the csv file """
+    ) -> tuple:
+    """ Returns the output row for the record, Undefined where a field is missing """
     lor, seq = filename.split('-')
     seq = seq.strip(".png")
 
@@ -233,27 +277,34 @@ def write_to_csv(
 
     description = description or 'Undefined'
 
-    to_write: str = (
-        f'{filename}\t',
-        f'{lor}\t',
-        f'{seq}\t',
-        f'{elr}\t',
-        f'{miles}\t',
-        f'{chains}\t',
-        f'{yards}\t',
-        f'{description}\n'
-    )
+    return (filename, lor, seq, elr, miles, chains, yards, description)
 
-    with open(TSV, 'a', encoding='utf-8') as file:
-        file.write(''.join(to_write))
+def write_to_csv(
+        filename: str,
+        elr: List[Union[str, None]],
+        mileage: List[Union[Mileage, None]],
+        description: str,
+        writer: RecordWriter = None
+    ):
+    """ Writes the data to the csv file, through the writer's buffer where given """
+    row = make_row(filename, elr, mileage, description)
+    if writer:
+        writer.write(row)
+        return
+    with RecordWriter(TSV) as single:
+        single.write(row)
 
-def run_extract(file: str) -> dict:
-    """ Run the process for the provided file """
+def extract_record(file: str) -> tuple:
+    """ Extract and parse the description, ELR and mileages for the file """
 
     print(f'Processing: {file}')
-    extract = parse_image(file)
+    with report.stage('extract_tables'):
+        extract = parse_image(file)
 
-    values = extract_values(extract.df)
+    return parse_values(extract_values(extract.df))
+
+def parse_values(values: dict) -> tuple:
+    """ Parse the raw table values into (elr, mileages, description) """
     print(f'\t{values}')
 
     description = parse_description(values.get('raw_desc'))
@@ -262,27 +313,201 @@ def run_extract(file: str) -> dict:
     elr = parse_elr(values.get('raw_elr'))
     print(f'\t\t{elr}')
 
-    mileages = parse_mileages(values.get('raw_mileages'))
+    with report.stage('parse_mileages'):
+        mileages = parse_mileages(values.get('raw_mileages'))
     print(f'\t\t{mileages}')
 
-    write_to_csv(
-        os.path.basename(file),
-        elr,
-        mileages,
-        description
-    )
+    return elr, mileages, description
 
-    if not all([description, elr[0], mileages[0]]):
-        print('\t\tFAILED!')
-        move_folder(file, os.path.basename(file), FAILED)
-        return
-
-    move_folder(file, os.path.basename(file))
+def is_complete(
+        elr: List[Union[str, None]],
+        mileages: List[Union[Mileage, None]],
+        description: str
+    ) -> bool:
+    """ Returns True if the description, ELR and mileage were all found """
+    return all([description, elr[0], mileages[0]])
 
-def multiple_run() -> None:
-    """ Run on all files in the processed directory """
-    for image in get_images():
-        run_extract(os.path.join(PATH, image))
+def save_record(
+        file: str,
+        elr: List[Union[str, None]],
+        mileages: List[Union[Mileage, None]],
+        description: str,
+        writer: RecordWriter = None,
+        ledger: Union[Ledger, None] = None
+    ) -> None:
+    """ Write the record and move the file to the meta or failed folder
+
+    With the ledger the row is committed there ahead of the move, the
+    output file is rebuilt from the ledger at the end of the run.
+    """
+    name = os.path.basename(file)
+    folder = META
+    if not is_complete(elr, mileages, description):
+        print(f'\t\tFAILED! {name}')
+        report.count('records_failed')
+        folder = FAILED
+    else:
+        report.count('records_accepted')
+
+    if ledger:
+        row = make_row(name, elr, mileages, description)
+        ledger.finish(name, 'data_extract', {'row': row, 'folder': folder}, file_key(file))
+    else:
+        write_to_csv(name, elr, mileages, description, writer)
+    move_folder(file, name, folder)
+
+def run_extract(file: str, writer: RecordWriter = None, ledger: Union[Ledger, None] = None) -> None:
+    """ Run the process for the provided file """
+    save_record(file, *extract_record(file), writer, ledger)
+
+def job(ledger: Union[Ledger, None], file: str):
+    """ The ledger job for the file, a no-op context without the ledger """
+    if not ledger:
+        return nullcontext()
+    return ledger.job(os.path.basename(file), 'data_extract')
+
+def resume(ledger: Ledger, files: List[str]) -> List[str]:
+    """ Move the files an interrupted run had already extracted, returns
+    the files still to extract """
+    remaining = []
+    for file in files:
+        output = ledger.get(os.path.basename(file), 'data_extract', file_key(file))
+        if not output:
+            remaining.append(file)
+            continue
+        report.count('records_resumed')
+        move_folder(file, os.path.basename(file), output['folder'])
+    return remaining
+
+def rebuild_tsv(ledger: Ledger) -> None:
+    """ Write the output file afresh from every row in the ledger """
+    for path in [TSV, record_writer.parquet_path(TSV)]:
+        if os.path.isfile(path):
+            os.remove(path)
+    with RecordWriter(TSV) as writer:
+        writer.write_many(output['row'] for output in ledger.outputs('data_extract').values())
+
+def init_worker(backend: str, threads: int, settings: preprocess.Settings = None) -> None:
+    """ Create the OCR reader once per worker process """
+    global BACKEND, TORCH_THREADS, PREPROCESS  # pylint: disable=W0603
+    BACKEND, TORCH_THREADS, PREPROCESS = backend, threads, settings
+    get_reader.cache_clear()
+    get_reader()
+
+def pool_extract(file: str) -> tuple:
+    """ Extract the record on a pool worker, returned with the stage
+    timings and OCR cache counts it took for the parent to merge """
+    cache = get_reader().cache
+    before = cache.stats()
+    record = extract_record(file)
+    after = cache.stats()
+    return record, report.drain(), {key: after[key] - before[key] for key in after}
+
+def prune_tsv(names: List[str]) -> None:
+    """ Remove the rows for the named drawings from the output files """
+    drop_files(TSV, [f'{name}.png' for name in names])
+
+def multiple_run(incremental: bool = False, workers: int = 1, use_ledger: bool = False) -> None:
+    """ Run on all files in the processed directory
+
+    In incremental mode the rows for drawings removed since the previous
+    run, or changed and waiting in the processed directory, are dropped
+    before the new extracts are appended. Changed drawings read from the
+    PDF text layer have already had their rows replaced by rip.
+    With more than one worker the extraction runs on a process pool and
+    this process alone writes the results, in sorted file order.
+
+    With the ledger, files an interrupted run had already extracted are
+    moved without OCR, a file that raises is recorded as failed and
+    retried on the next run, and the output file is rebuilt from the
+    ledger so no row is ever duplicated.
+    """
+    setup_dirs()
+    ledger = Ledger() if use_ledger else None
+    if incremental and os.path.isfile(DELTA):
+        with open(DELTA, encoding='utf-8') as file:
+            delta = json.load(file)
+        changed = [
+            name for name in delta['changed'] if os.path.isfile(os.path.join(PATH, f'{name}.png'))
+        ]
+        prune_tsv(changed + delta['removed'])
+        if ledger:
+            ledger.forget([f'{name}.png' for name in delta['removed']], 'data_extract')
+
+    files = [os.path.join(PATH, image) for image in get_images()]
+    if ledger:
+        files = resume(ledger, files)
+
+    with RecordWriter(TSV) as writer:
+        if workers <= 1:
+            for file in files:
+                with job(ledger, file):
+                    run_extract(file, writer, ledger)
+            print(f'OCR cache: {get_reader().cache.stats()}')
+            report.set('ocr_cache', get_reader().cache.stats())
+        else:
+            with ProcessPoolExecutor(
+                    max_workers=workers,
+                    initializer=init_worker,
+                    initargs=(BACKEND, TORCH_THREADS, PREPROCESS)
+                ) as pool:
+                futures = [pool.submit(pool_extract, file) for file in files]
+                cache_stats = {'hits': 0, 'misses': 0}
+                for file, future in zip(files, futures):
+                    with job(ledger, file):
+                        record, stages, counts = future.result()
+                        report.merge(stages)
+                        for key, value in counts.items():
+                            cache_stats[key] = cache_stats.get(key, 0) + value
+                        save_record(file, *record, writer, ledger)
+            print(f'OCR cache: {cache_stats}')
+            report.set('ocr_cache', cache_stats)
+
+    if ledger:
+        rebuild_tsv(ledger)
+        print(f'Ledger: {ledger.summary()}')
+
+def main(argv: Union[List[str], None] = None) -> None:
+    """ Entrypoint """
+    global BACKEND, TORCH_THREADS, PREPROCESS  # pylint: disable=W0603
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--workers', type=int, default=WORKERS, help='extraction processes')
+    parser.add_argument('--incremental', action='store_true',
+                        help='replace the rows of drawings changed since the last run')
+    parser.add_argument('--backend', choices=BACKENDS, default=BACKEND, help='OCR backend')
+    parser.add_argument('--threads', type=int,
+                        help='torch threads per worker, by default the cores shared between them')
+    parser.add_argument('--parquet', action='store_true',
+                        help='also write typed output to output.parquet')
+    parser.add_argument('--profile', action='store_true', help='cProfile each stage into reports/')
+    parser.add_argument('--preprocess', action='store_true',
+                        help='crop, downscale, deskew and binarise the drawings for img2table')
+    parser.add_argument('--region', type=float, nargs=4, default=preprocess.TABLE_REGION,
+                        metavar=('LEFT', 'TOP', 'RIGHT', 'BOTTOM'),
+                        help='header table region as fractions of the drawing')
+    parser.add_argument('--dpi', type=int, default=preprocess.TARGET_DPI,
+                        help='downscale to this DPI, relative to --source-dpi')
+    parser.add_argument('--source-dpi', type=int, default=preprocess.SOURCE_DPI,
+                        help='resolution the drawings were scanned at')
+    parser.add_argument('--no-deskew', action='store_true', help='skip deskewing')
+    parser.add_argument('--no-binarise', action='store_true', help='skip Otsu binarisation')
+    parser.add_argument('--ledger', action='store_true',
+                        help='record each drawing in ledger.sqlite, resuming an interrupted run')
+    args = parser.parse_args(argv)
+
+    PREPROCESS = preprocess.Settings(
+        tuple(args.region), args.dpi, not args.no_deskew, not args.no_binarise, args.source_dpi
+    ) if args.preprocess else None
+
+    record_writer.WRITE_PARQUET = args.parquet
+    instrument.PROFILE = args.profile
+
+    BACKEND = args.backend
+    TORCH_THREADS = args.threads or max(1, (os.cpu_count() or 1) // max(1, args.workers))
+    get_reader.cache_clear()
+    with report.stage('multiple_run'):
+        multiple_run(args.incremental, args.workers, args.ledger)
+    report.write('data_extract')
 
 if __name__ == '__main__':
-    multiple_run()
+    main()
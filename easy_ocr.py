@@ -6,18 +6,32 @@ from typing import List, Tuple, Dict
 from img2table.ocr import EasyOCR
 from img2table.document.base import Document
 
+from ocr_cache import OcrCache
+
 class EasyOcrCustom(EasyOCR):
     """ EasyOCR object"""
 
-    def __init__(self, lang: List[str] = ['en'], kw: Dict = None):
+    def __init__(
+            self,
+            lang: List[str] = ['en'],
+            kw: Dict = None,
+            cache: OcrCache = None,
+            options: Dict = None
+        ):
+        self.options = {'width_ths': 0.9, 'batch_size': 10, **(options or {})}
+        self.params = {'lang': lang, **self.options, **(kw or {})}
         super().__init__(lang, kw)
+        self.cache = cache
+
+    def readtext(self, image) -> List[Tuple]:
+        return self.reader.readtext(image, **self.options)
 
     def content(self, document: Document) -> List[List[Tuple]]:
-        # Get OCR of all images
-        ocrs = [self.reader.readtext(
-            image,
-            width_ths=0.9,
-            batch_size=10
-        ) for image in document.images]
-
-        return ocrs
+        # Get OCR of all images, from the cache where available
+        if not self.cache:
+            return [self.readtext(image) for image in document.images]
+
+        return [
+            self.cache.fetch(image, self.params, lambda image=image: self.readtext(image))
+            for image in document.images
+        ]
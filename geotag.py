@@ -3,15 +3,22 @@ GeoTag images """
 
 #pylint: disable=E0401
 
-from functools import lru_cache
 from typing import Union, List
+import argparse
 import os
 import sys
-from PIL import Image
-import geopandas as gpd
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ExifTags
+from PIL.TiffImagePlugin import IFDRational
 import pandas as pds
-from GPSPhoto import gpsphoto
-from pyproj import CRS
+import numpy as np
+
+import instrument
+import record_writer
+from instrument import report, timed
+from ledger import Ledger, file_key
+from mp_index import MilepostIndex
+from record_writer import RecordWriter, parquet_path, read_frame
 
 WRK_DIR = "."
 MP_GEO = os.path.join(WRK_DIR, "mileposts.gpkg")
@@ -19,6 +26,8 @@ CORRECTED = os.path.join(WRK_DIR, "corrected_full.tsv")
 TAGGED = os.path.join(WRK_DIR, "geo_tagged.tsv")
 TAG_DIR = os.path.join(WRK_DIR, "tagged")
 IMG_DIR = os.path.join(".", "meta")
+YARDS_PER_MILE = 1760
+WORKERS = os.cpu_count() or 1
 TSV_HEADER = [
     'file',
     'lor',
@@ -30,32 +39,29 @@ TSV_HEADER = [
     'desc'
 ]
 
-crs = CRS.from_string('EPSG:4326')
-
-for path in [
-        TAG_DIR
-    ]:
-    if not os.path.isdir(path):
-        os.mkdir(path)
+def setup_dirs() -> None:
+    """ Create the working directories where missing """
+    for path in [
+            TAG_DIR
+        ]:
+        if not os.path.isdir(path):
+            os.mkdir(path)
 
 class GeoTag:
     """ GeoTag images """
-    GEO = gpd.read_file(MP_GEO)
-    TSV = pds.read_csv(CORRECTED, delimiter="\t", names=TSV_HEADER)
 
-    @classmethod
-    def _get_valid_elr_geo(cls) -> list:
-        """ Returns a list of valid ELR codes """
-        return list(GeoTag.GEO.filter(items=['ELR']).drop_duplicates()["ELR"])
-
-    @classmethod
-    def _get_elr_tsv(cls) -> list:
+    def _get_elr_tsv(self) -> list:
         """ Returns a list of ELR codes from TSV output """
-        return list(GeoTag.TSV.filter(items=["elr"]).drop_duplicates()["elr"])
+        return list(self.tsv.filter(items=["elr"]).drop_duplicates()["elr"])
 
-    def __init__(self):
+    def __init__(self, gpkg: str = MP_GEO, corrected: str = CORRECTED):
         """ Initialisation """
-        self.valid_elr = self._get_valid_elr_geo()
+        self.corrected = corrected
+        with report.stage('load_index'):
+            self.index = MilepostIndex(gpkg)
+        with report.stage('load_tsv'):
+            self.tsv = read_frame(corrected, TSV_HEADER)
+        self.valid_elr = self.index.elrs()
         self.output_elr = self._get_elr_tsv()
 
     def check_elr_errors(self) -> Union[None, List[str]]:
@@ -68,96 +74,187 @@ class GeoTag:
             return None
         return err
 
-    @lru_cache
-    def return_matching_elr(self, elr: str) -> gpd.GeoDataFrame:
-        """ Return matching geo records for elr """
-        return self.GEO[self.GEO['ELR'] == elr]
-
     @staticmethod
-    def closest_match(value: float, frame: gpd.GeoDataFrame):
-        """ Return the Milepost Record which is the closest match """
-        return frame.iloc[(frame['VALUE']-value).abs().argsort()[:1]]
+    def linear_reference(miles: pds.Series, yards: pds.Series) -> np.ndarray:
+        """ Convert miles and yards (chains are held as yards) to decimal miles """
+        return miles.astype(float).to_numpy() + yards.astype(float).to_numpy() / YARDS_PER_MILE
 
     @staticmethod
-    def format_as_tsv(values: list) -> str:
-        """ Format for tsv entry """
-        sep = '\t'
-        values = [str(value) for value in values]
-        return sep.join(values)
+    def interpolate(
+            values: np.ndarray,
+            lons: np.ndarray,
+            lats: np.ndarray,
+            targets: np.ndarray
+        ) -> tuple:
+        """ Interpolate between the bracketing mileposts for each target
 
-    @staticmethod
-    def write_to_tsv(line: str) -> None:
-        """ Append to the output file """
-        with open(TAGGED, '+a', encoding='utf-8') as file:
-            file.write(f'{line}\n')
+        Targets beyond either end of the ELR are clamped to the end post.
+        Returns lon, lat, the position of the nearest milepost and the
+        error estimate: the distance in yards to that milepost.
+        """
+        if len(values) == 1:
+            nearest = np.zeros(len(targets), dtype=np.int64)
+            err = np.abs(targets - values[0]) * YARDS_PER_MILE
+            return lons[nearest], lats[nearest], nearest, err
+
+        right = np.searchsorted(values, targets).clip(1, len(values) - 1)
+        left = right - 1
+        span = values[right] - values[left]
+        frac = np.divide(
+            targets - values[left],
+            span,
+            out=np.zeros(len(targets)),
+            where=span > 0
+        ).clip(0, 1)
+
+        lon = lons[left] + frac * (lons[right] - lons[left])
+        lat = lats[left] + frac * (lats[right] - lats[left])
+        nearest = np.where(frac <= 0.5, left, right)
+        err = np.abs(targets - values[nearest]) * YARDS_PER_MILE
+        return lon, lat, nearest, err
+
+    @timed('match_to_mp')
+    def match_to_mp(self, replace: bool = False) -> pds.DataFrame:
+        """ Position every TSV entry along its ELR, with replace the output
+        of any earlier run is removed rather than appended to """
+        frame = self.tsv.reset_index(drop=True)
+        mileages = self.linear_reference(frame['m'], frame['yds'])
+
+        lon = np.empty(len(frame))
+        lat = np.empty(len(frame))
+        parent = np.empty(len(frame), dtype=np.int64)
+        err = np.empty(len(frame))
+        for elr, rows in frame.groupby('elr').indices.items():
+            values, elr_lon, elr_lat, elr_parent = self.index.lookup(elr)
+            lon[rows], lat[rows], nearest, err[rows] = self.interpolate(
+                values, elr_lon, elr_lat, mileages[rows]
+            )
+            parent[rows] = elr_parent[nearest]
+
+        frame['lon'] = lon
+        frame['lat'] = lat
+        frame['parent'] = parent
+        frame['err'] = err.round(1)
+        report.count('records_tagged', len(frame))
+
+        if replace:
+            for path in [TAGGED, parquet_path(TAGGED)]:
+                if os.path.isfile(path):
+                    os.remove(path)
+        with RecordWriter(TAGGED, columns=list(frame)) as writer:
+            writer.write_many(frame.itertuples(index=False, name=None))
+        return frame
 
     @staticmethod
-    def return_coordinates(closest: gpd.GeoDataFrame) -> tuple:
-        """ Extract coordinates and parent record """
-
-        closest = closest.to_crs(crs=crs)
-        lon = closest.geometry.x.to_string()
-        parent, lon = lon.split()
-        lat = closest.geometry.y.to_string().split()[1]
-        return (lon, lat, parent)
-
-    def match_to_mp(self) -> pds.DataFrame:
-        """ Match a TSV entry to a milepost """
-        self.TSV.reset_index()
-        for _, row in self.TSV.iterrows():
-            elr = row.get('elr')
-            miles = row.get('m')
-            yards = row.get('yds')
-            mileage = float(f'{miles}.{yards}')
-            matches = self.return_matching_elr(elr)
-            closest = self.closest_match(mileage, matches)
-            row['lon'], row['lat'], row['parent'] = self.return_coordinates(closest)
-            self.write_to_tsv(self.format_as_tsv(list(row)))
-
-        return pds.read_csv(TAGGED, delimiter='\t', names=TSV_HEADER + ['lon', 'lat', 'parent'])
+    def to_dms(value: float) -> tuple:
+        """ Convert decimal degrees to EXIF degrees, minutes and seconds """
+        value = abs(value)
+        degrees = int(value)
+        minutes = int((value - degrees) * 60)
+        seconds = (value - degrees - minutes / 60) * 3600
+        return (
+            IFDRational(degrees, 1),
+            IFDRational(minutes, 1),
+            IFDRational(round(seconds * 10000), 10000)
+        )
 
     @staticmethod
-    def set_gps_location(frame: pds.DataFrame) -> None:
-        """ Set the gps location for all files in the dataframe """
+    def gps_exif(lat: float, lon: float) -> Image.Exif:
+        """ Returns EXIF data holding the GPS location """
+        exif = Image.Exif()
+        exif[ExifTags.Base.GPSInfo] = {
+            ExifTags.GPS.GPSVersionID: b'\x02\x00\x00\x00',
+            ExifTags.GPS.GPSLatitudeRef: 'N' if lat >= 0 else 'S',
+            ExifTags.GPS.GPSLatitude: GeoTag.to_dms(lat),
+            ExifTags.GPS.GPSLongitudeRef: 'E' if lon >= 0 else 'W',
+            ExifTags.GPS.GPSLongitude: GeoTag.to_dms(lon)
+        }
+        return exif
 
-        for _, row in frame.iterrows():
-            file = os.path.join(TAG_DIR, row.get('file').replace("png", "jpg"))
-            lat = row.get('lat')
-            lon = row.get('lon')
-            photo = gpsphoto.GPSPhoto(file)
-            info = gpsphoto.GPSInfo((lat, lon))
-            photo.modGPSData(info, file)
+    @staticmethod
+    def tag_file(file: str, lat: float, lon: float) -> None:
+        """ Convert the PNG to JPEG with the GPS location, in a single write """
+        with Image.open(os.path.join(IMG_DIR, file)) as png:
+            rgb = png.convert('RGB')
+        new_path = os.path.join(TAG_DIR, file.replace("png", "jpg"))
+        rgb.save(new_path, exif=GeoTag.gps_exif(lat, lon))
 
     @staticmethod
-    def convert_file(file: str) -> None:
-        """ Convert the PNG to JPEG """
-        filename = os.path.basename(file)
-        png = Image.open(os.path.join(IMG_DIR, file))
-        rgb = png.convert('RGB')
-        new_path = os.path.join(TAG_DIR, filename.replace("png", "jpg"))
-        rgb.save(new_path)
+    def is_tagged(ledger: Ledger, file: str, lat: float, lon: float) -> bool:
+        """ Returns True if the ledger holds a tag at this location for the
+        current image and the JPEG is still in place """
+        output = ledger.get(file, 'geotag', file_key(os.path.join(IMG_DIR, file)))
+        return bool(output) and output == {'lat': lat, 'lon': lon} and os.path.isfile(
+            os.path.join(TAG_DIR, file.replace("png", "jpg"))
+        )
 
     @staticmethod
-    def prep_png() -> None:
-        """ Create a JPG version of each PNG file """
-        for each_path in os.listdir(IMG_DIR):
-            GeoTag.convert_file(each_path)
+    @timed('tag_images')
+    def tag_images(
+            frame: pds.DataFrame,
+            workers: int = WORKERS,
+            ledger: Union[Ledger, None] = None
+        ) -> None:
+        """ Convert and tag each image with a geotag row on a thread pool,
+        with the ledger images already tagged at the same location are skipped """
+        rows = []
+        for file, lat, lon in zip(frame['file'], frame['lat'], frame['lon']):
+            if not os.path.isfile(os.path.join(IMG_DIR, file)):
+                print(f'{file} not found in {IMG_DIR}')
+                report.count('images_missing')
+                continue
+            if ledger and GeoTag.is_tagged(ledger, file, float(lat), float(lon)):
+                report.count('images_resumed')
+                continue
+            rows.append((file, float(lat), float(lon)))
+        report.count('images_tagged', len(rows))
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(GeoTag.tag_file, *row) for row in rows]
+            for (file, lat, lon), future in zip(rows, futures):
+                if not ledger:
+                    future.result()
+                    continue
+                with ledger.job(file, 'geotag'):
+                    future.result()
+                    key = file_key(os.path.join(IMG_DIR, file))
+                    ledger.finish(file, 'geotag', {'lat': lat, 'lon': lon}, key)
 
-    def start_parse(self) -> None:
-        """ Parse the data """
+    def start_parse(self, use_ledger: bool = False) -> None:
+        """ Parse the data, with the ledger the output is replaced and images
+        tagged by an earlier run are not converted again """
+        setup_dirs()
         elr_errors = self.check_elr_errors()
         if elr_errors:
             print(
-                f"The following {len(elr_errors)} ELR(S) in '{CORRECTED}'\n",
+                f"The following {len(elr_errors)} ELR(S) in '{self.corrected}'\n",
                 f"are not found in '{MP_GEO}'\n",
                 f'{" ".join(elr_errors)}'
             )
             sys.exit(1)
 
-        tagged = self.match_to_mp()
-        self.prep_png()
-        self.set_gps_location(tagged)
+        ledger = Ledger() if use_ledger else None
+        tagged = self.match_to_mp(replace=use_ledger)
+        self.tag_images(tagged, ledger=ledger)
+
+def main(argv: Union[List[str], None] = None) -> None:
+    """ Entrypoint """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--profile', action='store_true', help='cProfile each stage into reports/')
+    parser.add_argument('--ledger', action='store_true',
+                        help='record each image in ledger.sqlite, skipping those already tagged')
+    parser.add_argument('--corrected', default=CORRECTED,
+                        help='corrected records, read from the Parquet file beside it '
+                        'where that is current, e.g. corrected.tsv from update_failed')
+    parser.add_argument('--parquet', action='store_true',
+                        help='also write typed output to geo_tagged.parquet')
+    args = parser.parse_args(argv)
+
+    instrument.PROFILE = args.profile
+    record_writer.WRITE_PARQUET = args.parquet
+    tag = GeoTag(corrected=args.corrected)
+    tag.start_parse(args.ledger)
+    report.write('geotag')
 
 if __name__ == "__main__":
-    tag = GeoTag()
-    tag.start_parse()
+    main()
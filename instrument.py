@@ -0,0 +1,146 @@
+""" Run level timing, counters and profiling for the pipeline stages """
+
+import cProfile
+import datetime
+import json
+import os
+import resource
+import time
+from collections import Counter
+from contextlib import contextmanager
+from functools import wraps
+from typing import Callable, Iterator, Union
+
+REPORT_DIR = os.path.join('.', 'reports')
+PROFILE = False
+
+def peak_rss_mb() -> dict:
+    """ Peak resident set size of this process and its reaped children """
+    return {
+        'self': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'children': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1)
+    }
+
+def rss_mb() -> float:
+    """ Current resident set size of this process, the peak where /proc is unavailable """
+    try:
+        with open('/proc/self/statm', encoding='ascii') as file:
+            pages = int(file.read().split()[1])
+        return round(pages * os.sysconf('SC_PAGE_SIZE') / (1 << 20), 1)
+    except (OSError, ValueError):
+        return peak_rss_mb()['self']
+
+class RunReport:
+    """ Stage timers, counters and rejection reasons for a single run """
+
+    def __init__(self):
+        """ Initialisation """
+        self.started = time.time()
+        self.stages = {}
+        self.counters = Counter()
+        self.rejected = Counter()
+        self.extra = {}
+        self.profilers = {}
+        self.profiling = False
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """ Time the enclosed block, profiling it where PROFILE is set.
+        Nested stages are timed but only the outermost is profiled """
+        profiler = None
+        if PROFILE and not self.profiling:
+            profiler = self.profilers.setdefault(name, cProfile.Profile())
+            self.profiling = True
+            profiler.enable()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            if profiler:
+                profiler.disable()
+                self.profiling = False
+            entry = self.stages.setdefault(name, {'seconds': 0.0, 'calls': 0, 'latencies': []})
+            entry['seconds'] += elapsed
+            entry['calls'] += 1
+            entry['latencies'].append(elapsed)
+
+    def percentiles(self, name: str, points: tuple = (50, 90, 99)) -> dict:
+        """ Latency percentiles in seconds over the calls of the stage """
+        latencies = sorted(self.stages.get(name, {}).get('latencies', []))
+        if not latencies:
+            return {}
+        return {
+            f'p{point}': round(latencies[min(len(latencies) - 1, len(latencies) * point // 100)], 4)
+            for point in points
+        }
+
+    def reset(self) -> None:
+        """ Discard everything recorded so far """
+        self.__init__()
+
+    def drain(self) -> dict:
+        """ Returns the stages timed so far and starts them afresh, so a
+        pool worker can hand its timings back with each result """
+        stages, self.stages = self.stages, {}
+        return stages
+
+    def merge(self, stages: dict) -> None:
+        """ Add stage timings drained from another process """
+        for name, other in stages.items():
+            entry = self.stages.setdefault(name, {'seconds': 0.0, 'calls': 0, 'latencies': []})
+            entry['seconds'] += other['seconds']
+            entry['calls'] += other['calls']
+            entry['latencies'].extend(other['latencies'])
+
+    def count(self, name: str, value: int = 1) -> None:
+        """ Increment a counter """
+        self.counters[name] += value
+
+    def reject(self, reason: str) -> None:
+        """ Count an image rejected for the reason, any detail in brackets is dropped """
+        self.rejected[reason.split(' (')[0]] += 1
+
+    def set(self, name: str, value) -> None:
+        """ Record an additional value in the report """
+        self.extra[name] = value
+
+    def to_dict(self) -> dict:
+        """ The report as a JSON serialisable dict """
+        return {
+            'started': datetime.datetime.fromtimestamp(self.started).isoformat(timespec='seconds'),
+            'wall_seconds': round(time.time() - self.started, 3),
+            'stages': {
+                name: {'seconds': round(entry['seconds'], 3), 'calls': entry['calls']}
+                for name, entry in self.stages.items()
+            },
+            'counters': dict(self.counters),
+            'rejected': dict(self.rejected),
+            'peak_rss_mb': peak_rss_mb(),
+            **self.extra
+        }
+
+    def write(self, script: str, folder: str = REPORT_DIR) -> Union[str, None]:
+        """ Write the JSON report and any stage profiles, returns the report path """
+        os.makedirs(folder, exist_ok=True)
+        stamp = datetime.datetime.fromtimestamp(self.started).strftime('%Y%m%d-%H%M%S')
+        for name, profiler in self.profilers.items():
+            profiler.dump_stats(os.path.join(folder, f'{script}_{stamp}_{name}.prof'))
+
+        path = os.path.join(folder, f'{script}_{stamp}.json')
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(self.to_dict(), file, indent=2)
+        print(f'Run report: {path}')
+        return path
+
+report = RunReport()
+
+def timed(name: str) -> Callable:
+    """ Decorator timing every call of the function as the named stage """
+    def decorator(func: Callable) -> Callable:
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with report.stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
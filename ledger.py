@@ -0,0 +1,118 @@
+""" SQLite job ledger: one row per item per stage, so an interrupted run
+resumes where it stopped without repeating completed work """
+
+# pylint: disable=E0401
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, Union
+
+LEDGER_PATH = os.path.join('.', 'ledger.sqlite')
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+def file_key(path: str) -> str:
+    """ Digest of the file content, identifies the input a job ran on """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class Ledger:
+    """ Status, timings and outputs of each item through each stage
+
+    A job is done once its output is committed, the file moves that
+    follow are replayed from that output on the next run if interrupted.
+    Failed jobs hold the error and are retried on the next run.
+    """
+
+    def __init__(self, path: str = LEDGER_PATH):
+        """ Initialisation """
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            'item TEXT NOT NULL, stage TEXT NOT NULL, key TEXT, status TEXT NOT NULL, '
+            'started REAL, finished REAL, output TEXT, error TEXT, '
+            'PRIMARY KEY (item, stage))'
+        )
+        self.conn.commit()
+
+    def get(self, item: str, stage: str, key: Union[str, None] = None) -> Union[dict, None]:
+        """ Returns the output of the completed job, None where the job is
+        not done or, with a key, ran on different content """
+        row = self.conn.execute(
+            'SELECT key, output FROM jobs WHERE item = ? AND stage = ? AND status = ?',
+            (item, stage, DONE)
+        ).fetchone()
+        if not row or (key and row[0] != key):
+            return None
+        return json.loads(row[1])
+
+    def start(self, item: str, stage: str, key: Union[str, None] = None) -> None:
+        """ Mark the job as running """
+        self.conn.execute(
+            'INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, NULL, NULL, NULL)',
+            (item, stage, key, RUNNING, time.time())
+        )
+        self.conn.commit()
+
+    def finish(self, item: str, stage: str, output: dict, key: Union[str, None] = None) -> None:
+        """ Commit the job output """
+        now = time.time()
+        self.conn.execute(
+            'INSERT INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, NULL) '
+            'ON CONFLICT (item, stage) DO UPDATE SET key = excluded.key, '
+            'status = excluded.status, finished = excluded.finished, '
+            'output = excluded.output, error = NULL',
+            (item, stage, key, DONE, now, now, json.dumps(output))
+        )
+        self.conn.commit()
+
+    def fail(self, item: str, stage: str, error: str) -> None:
+        """ Record the job as failed, it is retried on the next run """
+        self.conn.execute(
+            'UPDATE jobs SET status = ?, finished = ?, error = ? WHERE item = ? AND stage = ?',
+            (FAILED, time.time(), error, item, stage)
+        )
+        self.conn.commit()
+
+    @contextmanager
+    def job(self, item: str, stage: str, key: Union[str, None] = None) -> Iterator[None]:
+        """ Run the enclosed block as a job, an exception marks it failed
+        and is not raised so the run carries on with the next item """
+        self.start(item, stage, key)
+        try:
+            yield
+        except Exception as err:  # pylint: disable=W0718
+            print(f'{stage} failed for {item}: {err!r}')
+            self.fail(item, stage, repr(err))
+
+    def outputs(self, stage: str) -> Dict[str, dict]:
+        """ The outputs of every completed job in the stage, by item """
+        rows = self.conn.execute(
+            'SELECT item, output FROM jobs WHERE stage = ? AND status = ? ORDER BY item',
+            (stage, DONE)
+        )
+        return {item: json.loads(output) for item, output in rows}
+
+    def forget(self, items: Iterable[str], stage: str) -> None:
+        """ Remove the jobs for the items, e.g. drawings removed from the PDF """
+        self.conn.executemany(
+            'DELETE FROM jobs WHERE item = ? AND stage = ?', [(item, stage) for item in items]
+        )
+        self.conn.commit()
+
+    def summary(self) -> Dict[str, dict]:
+        """ Job counts by status for each stage """
+        counts: Dict[str, Counter] = {}
+        rows = self.conn.execute('SELECT stage, status, COUNT(*) FROM jobs GROUP BY stage, status')
+        for stage, status, count in rows:
+            counts.setdefault(stage, Counter())[status] = count
+        return {stage: dict(count) for stage, count in counts.items()}
@@ -0,0 +1,104 @@
+""" Manifest of extracted drawings for incremental runs """
+
+# pylint: disable=E0401
+
+import hashlib
+import json
+import os
+from typing import Union
+import fitz
+
+MANIFEST = os.path.join('.', 'manifest.json')
+DELTA = os.path.join('.', 'delta.json')
+
+def xref_digest(doc: fitz.Document, xref: int) -> str:
+    """ Digest of the raw image stream, no decoding required """
+    return hashlib.sha1(doc.xref_stream_raw(xref)).hexdigest()
+
+class Manifest:
+    """ Image digests per LOR-SEQ from previous runs
+
+    drawings maps each LOR-SEQ to the digest it was extracted from,
+    rejected holds the digests of images that were not Table A drawings
+    and pending maps temporary file names to digests awaiting OCR.
+    """
+
+    def __init__(self, path: str = MANIFEST):
+        """ Initialisation """
+        self.path = path
+        data = {}
+        if os.path.isfile(path):
+            with open(path, encoding='utf-8') as file:
+                data = json.load(file)
+        self.drawings = data.get('drawings', {})
+        self.rejected = set(data.get('rejected', []))
+        self.pending = data.get('pending', {})
+        self.seen = set(data.get('seen', []))
+        self.delta = data.get('delta', {'new': [], 'changed': []})
+        self.by_digest = {digest: name for name, digest in self.drawings.items()}
+
+    def start_run(self) -> None:
+        """ Reset the per run state ahead of a fresh extraction """
+        self.seen = set()
+        self.pending = {}
+        self.delta = {'new': [], 'changed': []}
+
+    def digests(self) -> set:
+        """ Digests of every image processed on previous runs """
+        return set(self.by_digest) | self.rejected
+
+    def is_known(self, digest: str) -> bool:
+        """ Returns True if the image was processed on a previous run """
+        if digest in self.by_digest:
+            self.seen.add(self.by_digest[digest])
+            return True
+        return digest in self.rejected
+
+    def stage(self, file_name: str, digest: str) -> None:
+        """ Record a newly extracted image awaiting OCR """
+        self.pending[file_name] = digest
+
+    def record(self, file_name: str, lor_seq: Union[str, None]) -> None:
+        """ Record the outcome of OCR for a staged image """
+        digest = self.pending.pop(file_name, None)
+        if not digest:
+            return
+        if not lor_seq:
+            self.rejected.add(digest)
+            return
+        if lor_seq in self.drawings:
+            self.by_digest.pop(self.drawings[lor_seq], None)
+            self.delta['changed'].append(lor_seq)
+        else:
+            self.delta['new'].append(lor_seq)
+        self.drawings[lor_seq] = digest
+        self.by_digest[digest] = lor_seq
+        self.seen.add(lor_seq)
+
+    def finish_run(self, path: str = DELTA) -> dict:
+        """ Drop drawings not seen this run and write the delta report """
+        removed = sorted(set(self.drawings) - self.seen)
+        for lor_seq in removed:
+            del self.by_digest[self.drawings.pop(lor_seq)]
+        delta = {
+            'new': sorted(self.delta['new']),
+            'changed': sorted(self.delta['changed']),
+            'removed': removed,
+            'unchanged': len(self.seen) - len(self.delta['new']) - len(self.delta['changed'])
+        }
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(delta, file, indent=2)
+        print(f'Delta: {len(delta["new"])} new, {len(delta["changed"])} changed, '
+              f'{len(removed)} removed, {delta["unchanged"]} unchanged')
+        return delta
+
+    def save(self) -> None:
+        """ Write the manifest to disk """
+        with open(self.path, 'w', encoding='utf-8') as file:
+            json.dump({
+                'drawings': self.drawings,
+                'rejected': sorted(self.rejected),
+                'pending': self.pending,
+                'seen': sorted(self.seen),
+                'delta': self.delta
+            }, file, indent=2)
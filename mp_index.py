@@ -0,0 +1,91 @@
+""" Milepost index built once from the GeoPackage and cached as Parquet """
+
+# pylint: disable=E0401, C0415
+
+import hashlib
+import os
+from typing import Dict, List, Tuple
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+MP_GEO = os.path.join('.', 'mileposts.gpkg')
+INDEX = os.path.join('.', 'mileposts.parquet')
+CRS = 'EPSG:4326'
+
+def file_sha256(path: str) -> str:
+    """ Hash of the file content """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def is_current(gpkg: str = MP_GEO, path: str = INDEX) -> bool:
+    """ Returns True if the index was built from the current GeoPackage,
+    the hash is only checked when the modified time differs. Where the
+    GeoPackage was touched or copied unchanged the new modified time is
+    recorded, so the hash is checked once rather than on every load """
+    if not os.path.isfile(path):
+        return False
+    meta = pq.read_schema(path).metadata or {}
+    mtime = str(os.stat(gpkg).st_mtime_ns).encode()
+    if meta.get(b'source_mtime') == mtime:
+        return True
+    if meta.get(b'source_sha256') != file_sha256(gpkg).encode():
+        return False
+    table = pq.read_table(path).replace_schema_metadata({**meta, b'source_mtime': mtime})
+    pq.write_table(table, f'{path}.tmp')
+    os.replace(f'{path}.tmp', path)
+    return True
+
+def build(gpkg: str = MP_GEO, path: str = INDEX) -> None:
+    """ Build the index: mileposts sorted by ELR and VALUE, pre-projected to lon/lat """
+    import geopandas as gpd
+
+    print(f'Building milepost index from {gpkg}')
+    geo = gpd.read_file(gpkg)
+    geo = geo.sort_values(['ELR', 'VALUE'], kind='stable')
+    projected = geo.to_crs(crs=CRS)
+    table = pa.table({
+        'ELR': pa.array(geo['ELR'].astype(str), pa.string()),
+        'VALUE': pa.array(geo['VALUE'].astype(float), pa.float64()),
+        'lon': pa.array(projected.geometry.x, pa.float64()),
+        'lat': pa.array(projected.geometry.y, pa.float64()),
+        'parent': pa.array(geo.index, pa.int64())
+    })
+    table = table.replace_schema_metadata({
+        'source_mtime': str(os.stat(gpkg).st_mtime_ns),
+        'source_sha256': file_sha256(gpkg)
+    })
+    pq.write_table(table, path)
+
+class MilepostIndex:
+    """ Sorted milepost values, lon/lat and parent record per ELR """
+
+    def __init__(self, gpkg: str = MP_GEO, path: str = INDEX):
+        """ Initialisation, rebuilding the index where the GeoPackage has changed """
+        if not is_current(gpkg, path):
+            build(gpkg, path)
+        table = pq.read_table(path, memory_map=True)
+        self.values = table.column('VALUE').to_numpy()
+        self.lon = table.column('lon').to_numpy()
+        self.lat = table.column('lat').to_numpy()
+        self.parent = table.column('parent').to_numpy()
+
+        elrs = table.column('ELR').to_numpy()
+        bounds = np.flatnonzero(elrs[1:] != elrs[:-1]) + 1
+        starts = np.concatenate(([0], bounds)) if len(elrs) else bounds
+        ends = np.concatenate((bounds, [len(elrs)])) if len(elrs) else bounds
+        self.slices: Dict[str, slice] = {
+            elrs[start]: slice(start, end) for start, end in zip(starts, ends)
+        }
+
+    def elrs(self) -> List[str]:
+        """ Returns the valid ELR codes """
+        return list(self.slices)
+
+    def lookup(self, elr: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """ Returns the sorted values, lon, lat and parent arrays for the ELR """
+        rows = self.slices[elr]
+        return self.values[rows], self.lon[rows], self.lat[rows], self.parent[rows]
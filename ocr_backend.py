@@ -0,0 +1,70 @@
+""" OCR backend selection for GPU and GPU-less hosts """
+
+# pylint: disable=E0401, C0415, R0903
+
+from typing import Dict, List, Union
+import numpy as np
+
+BACKENDS = ['easyocr', 'easyocr-cpu', 'tesseract']
+TESSERACT_CONFIG = '--psm 11'
+# EasyOCR detects text on a canvas of up to 2560 px, the title block and
+# table text stays legible at a smaller canvas and detection time falls
+# with its area
+CPU_CANVAS_SIZE = 1600
+
+def easyocr_kw(backend: str, threads: int) -> Dict:
+    """ easyocr.Reader arguments for the backend
+
+    The torch thread count is capped for every EasyOCR backend so parallel
+    workers don't oversubscribe, the default backend also runs on the CPU
+    where no GPU is found. The CPU backend skips the CUDA probe. EasyOCR
+    quantises its models whenever it runs on the CPU.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f'Unknown OCR backend: {backend}, expected one of {BACKENDS}')
+
+    import torch
+    torch.set_num_threads(threads)
+    return {'gpu': backend != 'easyocr-cpu'}
+
+def readtext_kw(backend: str) -> Dict:
+    """ readtext arguments for the backend, the CPU backend detects text
+    on a CPU_CANVAS_SIZE canvas """
+    if backend == 'easyocr-cpu':
+        return {'canvas_size': CPU_CANVAS_SIZE}
+    return {}
+
+class TesseractReader:
+    """ pytesseract behind the parts of the easyocr.Reader interface in use """
+
+    def __init__(self, lang: str = 'eng', config: str = TESSERACT_CONFIG):
+        """ Initialisation """
+        import pytesseract
+        self.tesseract = pytesseract
+        self.lang = lang
+        self.config = config
+
+    def readtext(self, image: Union[str, np.ndarray], detail: int = 1, **_) -> list:
+        """ Returns the words found, with bounding box and confidence where detail is set """
+        data = self.tesseract.image_to_data(
+            image,
+            lang=self.lang,
+            config=self.config,
+            output_type=self.tesseract.Output.DICT
+        )
+        results = []
+        for pos, text in enumerate(data['text']):
+            conf = float(data['conf'][pos])
+            if not text.strip() or conf < 0:
+                continue
+            left, top = data['left'][pos], data['top'][pos]
+            right, bottom = left + data['width'][pos], top + data['height'][pos]
+            bbox = [[left, top], [right, top], [right, bottom], [left, bottom]]
+            results.append((bbox, text, conf / 100))
+        if not detail:
+            return [text for _, text, _ in results]
+        return results
+
+    def readtext_batched(self, images: List[np.ndarray], detail: int = 1, **_) -> List[list]:
+        """ Tesseract has no batch mode, each image is read in turn """
+        return [self.readtext(image, detail) for image in images]
@@ -0,0 +1,105 @@
+""" Persistent OCR result cache keyed by image content """
+
+# pylint: disable=E0401
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from typing import Callable, Union
+import numpy as np
+
+CACHE_PATH = os.path.join('.', 'ocr_cache.sqlite')
+MAX_BYTES = 512 * 1024 * 1024
+
+def to_json(value) -> Union[int, float, list]:
+    """ JSON encoder for the numpy types found in EasyOCR results """
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError(f'Unable to serialise {type(value)}')
+
+def from_json(value: list) -> list:
+    """ Restore the (bbox, text, confidence) tuples of a detailed result """
+    return [tuple(item) if isinstance(item, list) else item for item in value]
+
+class OcrCache:
+    """ SQLite backed OCR cache with size based LRU eviction """
+
+    def __init__(self, path: str = CACHE_PATH, max_bytes: int = MAX_BYTES):
+        """ Initialisation """
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS ocr ('
+            'key TEXT PRIMARY KEY, value TEXT NOT NULL, '
+            'size INTEGER NOT NULL, accessed REAL NOT NULL)'
+        )
+        self.conn.commit()
+
+    @staticmethod
+    def make_key(image: Union[str, bytes, np.ndarray], params: dict) -> str:
+        """ Hash of the image content and the OCR parameters """
+        digest = hashlib.sha256()
+        if isinstance(image, str):
+            with open(image, 'rb') as file:
+                for chunk in iter(lambda: file.read(1 << 20), b''):
+                    digest.update(chunk)
+        elif isinstance(image, np.ndarray):
+            digest.update(f'{image.shape}{image.dtype.str}'.encode())
+            digest.update(np.ascontiguousarray(image).data)
+        else:
+            digest.update(image)
+        digest.update(json.dumps(params, sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Union[list, None]:
+        """ Returns the cached result, None on a miss """
+        row = self.conn.execute('SELECT value FROM ocr WHERE key = ?', (key,)).fetchone()
+        if not row:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.conn.execute('UPDATE ocr SET accessed = ? WHERE key = ?', (time.time(), key))
+        self.conn.commit()
+        return from_json(json.loads(row[0]))
+
+    def put(self, key: str, value: list) -> None:
+        """ Store a result, evicting the least recently used where required """
+        text = json.dumps(value, default=to_json)
+        self.conn.execute(
+            'INSERT OR REPLACE INTO ocr VALUES (?, ?, ?, ?)',
+            (key, text, len(text), time.time())
+        )
+        self.conn.commit()
+        self.evict()
+
+    def evict(self) -> None:
+        """ Drop the least recently used entries until under the size limit """
+        total = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM ocr').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self.conn.execute('SELECT key, size FROM ocr ORDER BY accessed').fetchall()
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            self.conn.execute('DELETE FROM ocr WHERE key = ?', (key,))
+            total -= size
+        self.conn.commit()
+
+    def fetch(self, image: Union[str, bytes, np.ndarray], params: dict, func: Callable) -> list:
+        """ Returns the cached result for the image, calling func on a miss """
+        key = self.make_key(image, params)
+        result = self.get(key)
+        if result is None:
+            result = func()
+            self.put(key, result)
+        return result
+
+    def stats(self) -> dict:
+        """ Hit and miss counters """
+        return {'hits': self.hits, 'misses': self.misses}
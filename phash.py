@@ -0,0 +1,155 @@
+""" Index of the title blocks OCR'd so far, so a drawing repeated across
+PDFs, or re-encoded, reuses the earlier OCR result """
+
+# pylint: disable=E0401, E1101
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from typing import Dict, List, Union
+import cv2
+import numpy as np
+
+from ocr_cache import from_json, to_json
+
+PHASH_PATH = os.path.join('.', 'phash.sqlite')
+# Each title block is held in memory as a small grayscale signature. Title
+# blocks are mostly blank, so the signatures of distinct drawings still
+# differ in more than MAX_SIGNATURE_CHANGED of their pixels, a re-encoded
+# copy in almost none of them
+SIGNATURE_SIZE = (192, 24)
+SIGNATURE_TOLERANCE = 32
+MAX_SIGNATURE_CHANGED = 0.003
+# Title blocks differing by a single character pass the signature check,
+# so a candidate is only taken as a duplicate when no more than MAX_CHANGED
+# of its full thumbnail pixels differ by PIXEL_TOLERANCE
+MAX_CHANGED = 0.0002
+PIXEL_TOLERANCE = 64
+# Signatures compared per step, bounding the memory of a lookup
+CHUNK = 1024
+
+def digest(thumb: np.ndarray) -> str:
+    """ Content digest of the thumbnail, equal only for identical pixels """
+    return hashlib.sha1(f'{thumb.shape}'.encode() + thumb.tobytes()).hexdigest()
+
+def signature(thumb: np.ndarray) -> np.ndarray:
+    """ The thumbnail reduced to SIGNATURE_SIZE, flattened """
+    return cv2.resize(thumb, SIGNATURE_SIZE, interpolation=cv2.INTER_AREA).flatten()
+
+def changed(first: np.ndarray, second: np.ndarray) -> float:
+    """ Share of the pixels differing by more than PIXEL_TOLERANCE """
+    if first.shape != second.shape:
+        return 1.0
+    return float((np.abs(first.astype(np.int16) - second) > PIXEL_TOLERANCE).mean())
+
+class HashIndex:
+    """ SQLite backed index of title block digests, signatures and thumbnails
+
+    An image is added ahead of OCR and its result recorded after. Images
+    still awaiting their result are only offered as duplicates on request,
+    with a result of None, so a batch can hold back their repeats.
+
+    Exact repeats are found by digest. Otherwise the signatures, kept in
+    memory, are compared in one pass and only the few close enough have
+    their thumbnail read back for the full pixel check.
+    """
+
+    def __init__(self, path: str = PHASH_PATH):
+        """ Initialisation """
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS titles ('
+            'item TEXT PRIMARY KEY, digest TEXT NOT NULL, signature BLOB NOT NULL, '
+            'thumb BLOB NOT NULL, result TEXT, file_name TEXT, added REAL NOT NULL)'
+        )
+        self.conn.commit()
+        self.items: List[str] = []
+        self.keys: List[str] = []
+        self.rows: Dict[str, int] = {}
+        self.digests: Dict[str, str] = {}
+        self.signatures = np.zeros((CHUNK, SIGNATURE_SIZE[0] * SIGNATURE_SIZE[1]), np.uint8)
+        self.done = np.zeros(CHUNK, bool)
+        rows = self.conn.execute(
+            'SELECT item, digest, signature FROM titles WHERE result IS NOT NULL'
+        )
+        for item, value, blob in rows:
+            self.index(item, value, np.frombuffer(blob, np.uint8), True)
+
+    def index(self, item: str, value: str, sig: np.ndarray, done: bool) -> None:
+        """ Hold the digest and signature of the item in memory """
+        row = self.rows.get(item)
+        if row is None:
+            row = len(self.items)
+            if row == len(self.done):
+                self.signatures = np.concatenate([self.signatures, np.zeros_like(self.signatures)])
+                self.done = np.concatenate([self.done, np.zeros_like(self.done)])
+            self.items.append(item)
+            self.keys.append(value)
+            self.rows[item] = row
+        else:
+            if self.digests.get(self.keys[row]) == item:
+                del self.digests[self.keys[row]]
+            self.keys[row] = value
+        self.signatures[row] = sig
+        self.done[row] = done
+        self.digests[value] = item
+
+    def candidates(self, sig: np.ndarray, pending: bool) -> List[int]:
+        """ Rows whose signature is within MAX_SIGNATURE_CHANGED, closest first """
+        found = []
+        for start in range(0, len(self.items), CHUNK):
+            block = self.signatures[start:start + CHUNK][:len(self.items) - start]
+            share = (np.abs(block.astype(np.int16) - sig) > SIGNATURE_TOLERANCE).mean(axis=1)
+            eligible = share <= MAX_SIGNATURE_CHANGED
+            if not pending:
+                eligible &= self.done[start:start + len(block)]
+            found += [(share[row], start + row) for row in np.flatnonzero(eligible)]
+        return [row for _, row in sorted(found)]
+
+    def entry(self, item: str) -> dict:
+        """ The item with its OCR result, None while pending, and destination """
+        result, file_name = self.conn.execute(
+            'SELECT result, file_name FROM titles WHERE item = ?', (item,)
+        ).fetchone()
+        result = from_json(json.loads(result)) if result is not None else None
+        return {'item': item, 'result': result, 'file_name': file_name}
+
+    def find(self, thumb: np.ndarray, pending: bool = False) -> Union[dict, None]:
+        """ Returns the item, OCR result and destination of the closest
+        duplicate of the thumbnail, None where there is none """
+        item = self.digests.get(digest(thumb))
+        if item and (pending or self.done[self.rows[item]]):
+            return self.entry(item)
+
+        for row in self.candidates(signature(thumb), pending):
+            blob, = self.conn.execute(
+                'SELECT thumb FROM titles WHERE item = ?', (self.items[row],)
+            ).fetchone()
+            other = cv2.imdecode(np.frombuffer(blob, np.uint8), cv2.IMREAD_GRAYSCALE)
+            if changed(thumb, other) <= MAX_CHANGED:
+                return self.entry(self.items[row])
+        return None
+
+    def add(self, item: str, thumb: np.ndarray) -> None:
+        """ Index the thumbnail of an image about to be OCR'd """
+        value, sig = digest(thumb), signature(thumb)
+        self.index(item, value, sig, False)
+        blob = cv2.imencode('.png', thumb)[1].tobytes()
+        self.conn.execute(
+            'INSERT OR REPLACE INTO titles VALUES (?, ?, ?, ?, NULL, NULL, ?)',
+            (item, value, sig.tobytes(), blob, time.time())
+        )
+        self.conn.commit()
+
+    def record(self, item: str, result: list, file_name: str) -> None:
+        """ Store the OCR result and destination of an indexed image """
+        if item not in self.rows:
+            return
+        self.conn.execute(
+            'UPDATE titles SET result = ?, file_name = ? WHERE item = ?',
+            (json.dumps(result, default=to_json), file_name, item)
+        )
+        self.conn.commit()
+        self.done[self.rows[item]] = True
@@ -0,0 +1,60 @@
+""" Pixmap conversions and the image size checks made before OCR """
+
+# pylint: disable=E0401
+
+import struct
+from typing import Tuple, Union
+import fitz
+import numpy as np
+
+MIN_WIDTH = 600
+MIN_HEIGHT = 400
+ASPECT_RANGE = (0.5, 2.5)
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+def png_ready(pix: fitz.Pixmap) -> fitz.Pixmap:
+    """ Returns the pixmap in a colourspace PNG can hold, alpha is kept as
+    PNG stores it, so gray and RGB images are saved without a copy """
+    if pix.colorspace and pix.colorspace.n not in (1, 3):
+        return fitz.Pixmap(fitz.csRGB, pix)
+    return pix
+
+def pixmap_to_rgb(pix: fitz.Pixmap) -> fitz.Pixmap:
+    """ Returns the pixmap as gray or RGB without alpha, converting only where needed """
+    if pix.colorspace and pix.colorspace.n not in (1, 3):
+        pix = fitz.Pixmap(fitz.csRGB, pix)
+    if pix.alpha:
+        pix = fitz.Pixmap(pix, 0)
+    return pix
+
+def pixmap_to_array(pix: fitz.Pixmap) -> np.ndarray:
+    """ View the pixmap samples as an array without copying,
+    the array is only valid while the pixmap is alive """
+    samples = np.frombuffer(pix.samples_mv, dtype=np.uint8)
+    if pix.n == 1:
+        return samples.reshape(pix.height, pix.width)
+    return samples.reshape(pix.height, pix.width, pix.n)
+
+def get_png_size(full_path: str) -> Union[Tuple[int, int], None]:
+    """ Read the width and height from the PNG header, without decoding """
+    with open(full_path, 'rb') as file:
+        header = file.read(24)
+    if len(header) < 24 or header[:8] != PNG_SIGNATURE:
+        return None
+    return struct.unpack('>II', header[16:24])
+
+def check_size(width: int, height: int) -> Union[str, None]:
+    """ Returns the reason for rejection based on the image dimensions """
+    if width < MIN_WIDTH or height < MIN_HEIGHT:
+        return f'too small ({width}x{height})'
+    if not ASPECT_RANGE[0] <= width / height <= ASPECT_RANGE[1]:
+        return f'aspect ratio ({width}x{height})'
+    return None
+
+def prefilter(full_path: str) -> Union[str, None]:
+    """ Cheap check before OCR, returns the reason for rejection
+    or None where the image may be a Table A drawing """
+    size = get_png_size(full_path)
+    if not size:
+        return 'not a png'
+    return check_size(*size)
@@ -0,0 +1,88 @@
+""" Shrink the drawings before table extraction: crop to the header
+table, downscale to a target DPI, deskew and binarise """
+
+# pylint: disable=E0401, E1101
+
+from collections import namedtuple
+from typing import Union
+import cv2
+import numpy as np
+
+# Header table region as fractions of the drawing width/height, the
+# default drops the title block along the bottom
+TABLE_REGION = (0.0, 0.0, 1.0, 0.85)
+# Resolution the drawings are taken to be at when downscaling, the
+# extracted images carry none of their own
+SOURCE_DPI = 300
+TARGET_DPI = 150
+MAX_SKEW = 5.0
+SKEW_WIDTH = 800
+
+Settings = namedtuple(
+    'Settings',
+    'region, dpi, deskew, binarise, source_dpi',
+    defaults=(TABLE_REGION, TARGET_DPI, True, True, SOURCE_DPI)
+)
+
+def crop(image: np.ndarray, region: tuple) -> np.ndarray:
+    """ Crop to the region, given as (left, top, right, bottom) fractions """
+    height, width = image.shape[:2]
+    left, top, right, bottom = region
+    return image[int(top * height):int(bottom * height), int(left * width):int(right * width)]
+
+def downscale(image: np.ndarray, dpi: int, source_dpi: int = SOURCE_DPI) -> np.ndarray:
+    """ Resize to the target DPI, images are never enlarged """
+    scale = dpi / source_dpi
+    if scale >= 1:
+        return image
+    return cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+def skew_angle(gray: np.ndarray) -> float:
+    """ The median angle in degrees of the long, near horizontal lines,
+    measured on a copy at most SKEW_WIDTH wide """
+    if gray.shape[1] > SKEW_WIDTH:
+        gray = downscale(gray, SKEW_WIDTH, gray.shape[1])
+    inverted = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)[1]
+    lines = cv2.HoughLinesP(
+        inverted,
+        1,
+        np.pi / 1800,
+        threshold=100,
+        minLineLength=gray.shape[1] // 4,
+        maxLineGap=5
+    )
+    if lines is None:
+        return 0.0
+    x_1, y_1, x_2, y_2 = lines[:, 0].T.astype(float)
+    angles = np.degrees(np.arctan2(y_2 - y_1, x_2 - x_1))
+    angles = angles[np.abs(angles) <= MAX_SKEW]
+    return float(np.median(angles)) if len(angles) else 0.0
+
+def deskew(gray: np.ndarray) -> np.ndarray:
+    """ Rotate the image so the table rules are level """
+    angle = skew_angle(gray)
+    if abs(angle) < 0.05:
+        return gray
+    height, width = gray.shape[:2]
+    matrix = cv2.getRotationMatrix2D((width / 2, height / 2), angle, 1.0)
+    return cv2.warpAffine(
+        gray, matrix, (width, height), flags=cv2.INTER_LINEAR, borderValue=255
+    )
+
+def binarise(gray: np.ndarray) -> np.ndarray:
+    """ Otsu threshold to black and white """
+    return cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1]
+
+def prepare(file: str, settings: Union[Settings, None]) -> Union[str, bytes]:
+    """ Returns the drawing prepared for img2table as PNG bytes, or the
+    file path unchanged where preprocessing is off """
+    if not settings:
+        return file
+    image = cv2.imread(file, cv2.IMREAD_GRAYSCALE)
+    image = crop(image, settings.region)
+    image = downscale(image, settings.dpi, settings.source_dpi)
+    if settings.deskew:
+        image = deskew(image)
+    if settings.binarise:
+        image = binarise(image)
+    return cv2.imencode('.png', image)[1].tobytes()
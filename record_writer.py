@@ -0,0 +1,153 @@
+""" Buffered TSV writer with optional typed Parquet output, shared by
+data_extract, update_failed and geotag """
+
+# pylint: disable=E0401, C0415
+
+import os
+from typing import Iterable, List, Sequence, Union
+
+NOT_SET_KW = 'Undefined'
+BUFFER_ROWS = 500
+WRITE_PARQUET = False
+COLUMNS = ['file', 'lor', 'seq', 'elr', 'm', 'ch', 'yds', 'desc', 'lon', 'lat', 'parent', 'err']
+TYPES = {
+    'm': 'int32',
+    'ch': 'int32',
+    'yds': 'int32',
+    'lon': 'float64',
+    'lat': 'float64',
+    'parent': 'int64',
+    'err': 'float64'
+}
+
+def parquet_path(path: str) -> str:
+    """ The Parquet file written alongside the TSV """
+    return f'{os.path.splitext(path)[0]}.parquet'
+
+def schema():
+    """ The stable Parquet schema, every column is nullable """
+    import pyarrow as pa
+    return pa.schema([(column, TYPES.get(column, 'string')) for column in COLUMNS])
+
+def to_typed(column: str, value) -> Union[str, int, float, None]:
+    """ Convert a TSV value to its Parquet type, Undefined becomes null """
+    if value is None or (isinstance(value, str) and NOT_SET_KW in value):
+        return None
+    kind = TYPES.get(column, 'string')
+    try:
+        if kind.startswith('int'):
+            return int(value)
+        if kind.startswith('float'):
+            return float(value)
+    except ValueError:
+        return None
+    return str(value)
+
+class RecordWriter:
+    """ Buffers rows and appends them to the TSV in batches
+
+    With parquet set the rows are also written to a typed Parquet file
+    with the COLUMNS schema, rows from earlier runs are kept.
+    """
+
+    def __init__(
+            self,
+            path: str,
+            columns: List[str] = None,
+            parquet: Union[bool, None] = None,
+            buffer_rows: int = BUFFER_ROWS
+        ):
+        """ Initialisation """
+        self.path = path
+        self.columns = columns or COLUMNS[:8]
+        self.parquet = WRITE_PARQUET if parquet is None else parquet
+        self.buffer_rows = buffer_rows
+        self.buffer: List[Sequence] = []
+        self.written: List[Sequence] = []
+
+    def __enter__(self) -> 'RecordWriter':
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+    def write(self, row: Sequence) -> None:
+        """ Buffer a row, flushing when the buffer is full """
+        self.buffer.append(row)
+        if len(self.buffer) >= self.buffer_rows:
+            self.flush()
+
+    def write_many(self, rows: Iterable[Sequence]) -> None:
+        """ Buffer several rows """
+        for row in rows:
+            self.write(row)
+
+    def flush(self) -> None:
+        """ Append the buffered rows to the TSV in a single write """
+        if not self.buffer:
+            return
+        with open(self.path, 'a', encoding='utf-8') as file:
+            file.writelines(
+                '\t'.join(str(value) for value in row) + '\n' for row in self.buffer
+            )
+        if self.parquet:
+            self.written.extend(self.buffer)
+        self.buffer = []
+
+    def close(self) -> None:
+        """ Flush the remaining rows and write the Parquet file """
+        self.flush()
+        if self.parquet and self.written:
+            self.write_parquet()
+
+    def write_parquet(self) -> None:
+        """ Write the rows, after any from earlier runs, to the Parquet file """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        data = {column: [] for column in COLUMNS}
+        for row in self.written:
+            values = dict(zip(self.columns, row))
+            for column in COLUMNS:
+                data[column].append(to_typed(column, values.get(column)))
+        table = pa.table(data, schema=schema())
+
+        path = parquet_path(self.path)
+        if os.path.isfile(path):
+            table = pa.concat_tables([pq.read_table(path).cast(schema()), table])
+        pq.write_table(table, f'{path}.tmp')
+        os.replace(f'{path}.tmp', path)
+        self.written = []
+
+def drop_files(path: str, files: Iterable[str]) -> None:
+    """ Remove the rows for the given files from the TSV and its Parquet file """
+    drop = set(files)
+    if os.path.isfile(path):
+        with open(path, encoding='utf-8') as file:
+            rows = file.readlines()
+        with open(path, 'w', encoding='utf-8') as file:
+            file.writelines(row for row in rows if row.split('\t', 1)[0] not in drop)
+
+    typed = parquet_path(path)
+    if os.path.isfile(typed):
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        import pyarrow.parquet as pq
+        table = pq.read_table(typed)
+        dropped = pc.is_in(table['file'], value_set=pa.array(list(drop), pa.string()))
+        table = table.filter(pc.invert(dropped))
+        pq.write_table(table, f'{typed}.tmp')
+        os.replace(f'{typed}.tmp', typed)
+
+def read_frame(path: str, columns: List[str], dtype=None):
+    """ Load the stage output, from the Parquet file where it is current.
+    dtype applies to the TSV only, the Parquet columns keep their types """
+    import pandas as pds
+
+    typed = parquet_path(path)
+    if os.path.isfile(typed) and (
+            not os.path.isfile(path) or os.path.getmtime(typed) >= os.path.getmtime(path)
+        ):
+        import pyarrow.parquet as pq
+        return pq.read_table(typed, columns=columns, memory_map=True).to_pandas()
+    return pds.read_csv(path, delimiter='\t', names=columns, dtype=dtype)
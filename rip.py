@@ -2,160 +2,946 @@
 
 # pylint: disable=R1713, E0401
 
-from collections import namedtuple
+from collections import deque, namedtuple
 import os
-import re
-from typing import Union
+from typing import Iterator, List, Sequence, Tuple, Union
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import argparse
 import datetime
-import easyocr
+from functools import lru_cache
 from tqdm import tqdm
 import fitz
+import cv2
+import numpy as np
+from ocr_cache import OcrCache
+from phash import HashIndex
+from manifest import Manifest, xref_digest
+from ledger import Ledger, file_key
+from pixmaps import check_size, pixmap_to_array, pixmap_to_rgb, png_ready, prefilter
+from ocr_backend import BACKENDS, TesseractReader, easyocr_kw, readtext_kw
+from record_writer import RecordWriter
+from title_fields import parse_fields
+import data_extract
+import text_layer
+import instrument
+from instrument import report, timed
 
-reader = easyocr.Reader(['en'], gpu=True)
+LANG = ['en']
 TableA = namedtuple('TABLE_A', 'file_path, lor, seq, updated')
+Region = namedtuple('Region', 'left, top, right, bottom')
 
-LOR = ['CY', 'EA', 'GW', 'LN', 'MD', 'NW', 'NZ', 'SC', 'SO', 'SW', 'XR']
-VALID_SEQ = re.compile("^[O0-9]{3}$")
-ALT_VALID_SEQ = re.compile("^[O0-9]{3}")
-VALID_DATE = re.compile("[0-9]{2}/[0-9]{2}/[0-9]{4}")
+DEFAULT_DATE = '01/01/1970'
 WORKDIR = '.'
 START_PAGE = 660
 END_PAGE = 699
 FAILED = 'failed'
 PROCESSED = 'processed'
 IMAGES = 'images'
+REVIEW = 'review'
+WORKERS = os.cpu_count() or 1
+BATCH_SIZE = 8
+BACKEND = 'easyocr'
+TORCH_THREADS = WORKERS
+USE_CACHE = True
+DEDUPE = True
+COLLISION_POLICIES = ['review', 'newest', 'suffix']
+COLLISION_POLICY = 'review'
+MEMORY_CHECK_INTERVAL = 16
 
-for path in [
-        os.path.join(WORKDIR, FAILED),
-        os.path.join(WORKDIR, PROCESSED),
-        os.path.join(WORKDIR, IMAGES)
-    ]:
-    if not os.path.isdir(path):
-        os.mkdir(path)
+# Title block regions as fractions of the drawing width/height
+TITLE_BLOCK = [Region(0.0, 0.85, 1.0, 1.0)]
+ROI_SCALE = 0.5
+# Drawings written straight to the data_extract meta directory this run
+Streamed = set()
+
+def setup_dirs() -> None:
+    """ Create the working directories where missing """
+    for path in [
+            os.path.join(WORKDIR, FAILED),
+            os.path.join(WORKDIR, PROCESSED),
+            os.path.join(WORKDIR, IMAGES),
+            os.path.join(WORKDIR, REVIEW)
+        ]:
+        if not os.path.isdir(path):
+            os.mkdir(path)
+
+@lru_cache(maxsize=None)
+def load_reader(backend: str):
+    """ Load the reader for the backend on first use, importing torch is slow """
+    if backend == 'tesseract':
+        return TesseractReader()
+    import easyocr  # pylint: disable=C0415
+    return easyocr.Reader(LANG, **easyocr_kw(backend, TORCH_THREADS))
+
+def get_reader():
+    """ Returns the reader for the configured backend """
+    return load_reader(BACKEND)
+
+def ocr_params() -> dict:
+    """ OCR parameters forming part of the cache key """
+    return {'backend': BACKEND, 'lang': LANG, 'detail': 1, **readtext_kw(BACKEND)}
+
+@lru_cache(maxsize=None)
+def get_cache() -> OcrCache:
+    """ Open the OCR cache on first use """
+    return OcrCache()
+
+@lru_cache(maxsize=None)
+def get_hashes() -> HashIndex:
+    """ Returns the perceptual hash index, opened on first use """
+    return HashIndex()
 
 def get_updated_date(values: list) -> str:
     """ Strips the updated date from the table A drawing """
-    for data in [value for value in values if len(value) == 10]:
-        result = VALID_DATE.match(data)
-        if result:
-            return result.group()
+    updated = parse_fields(values).updated
+    if updated:
+        return updated
     print('WARNING: Unable to parse date, using default')
-    return '01/01/1970'
-
-def create_regex() -> str:
-    """ Create the regex search string """
-    lor_str = ""
-    for lor in LOR:
-        lor_str += f"{lor}|"
-    return f"^({lor_str[:-1]}){{1}}[O0-9]{{3,4}}$"
-
-VALID_LOR = re.compile(create_regex())
+    return DEFAULT_DATE
 
 def get_lor(values: list) -> Union[str, None]:
     """ Attempts to find the LOR code """
-    for data in [value for value in values if len(value) in [5, 6]]:
-        result = VALID_LOR.match(data)
-        if result:
-            return result.group()
-    print('WARNING: Unable to parse LOR code')
-    return None
+    lor = parse_fields(values).lor
+    if not lor:
+        print('WARNING: Unable to parse LOR code')
+    return lor
 
 def get_seq(values:list) -> Union[str, None]:
     """ Returns the sequence number """
-    for data in [value for value in values if len(value) == 3]:
-        result = VALID_SEQ.match(data)
-        if result:
-            return result.group()
-    for data in values:
-        result = ALT_VALID_SEQ.match(data)
-        if result:
-            return result.group()
-    print('WARNING: Unable to parse page sequence')
-    return None
+    seq = parse_fields(values).seq
+    if not seq:
+        print('WARNING: Unable to parse page sequence')
+    return seq
 
 def format_filename(table_a: TableA) -> str:
     """ Returns the filename in the correct format """
 
     return f'{table_a.lor}-{table_a.seq}.png'
 
-def strip_images(all_pages: bool = False) -> None:
-    """ Strip all images and place in the image directory """
+def get_page_range(doc: fitz.Document, all_pages: bool = False) -> range:
+    """ Returns the range of pages to extract from """
+    if all_pages:
+        return range(len(doc))
+    return range(START_PAGE, END_PAGE)
+
+def shard_pages(rng: Sequence, workers: int) -> List[Sequence]:
+    """ Split the page range, or image plan, into contiguous shards, one per worker """
+    size = -(-len(rng) // workers)
+    return [rng[pos:pos + size] for pos in range(0, len(rng), size)]
+
+def plan_images(doc: fitz.Document, pages: range) -> List[Tuple[int, int]]:
+    """ Returns (page, xref) for the images on the pages, each xref once
+    under the first page it appears on, so shared images such as a logo
+    repeated on every page are extracted once """
+    seen = set()
+    plan = []
+    for i in pages:
+        for img in doc.get_page_images(i):
+            if img[0] in seen:
+                report.count('images_shared')
+                continue
+            seen.add(img[0])
+            plan.append((i, img[0]))
+    return plan
+
+def check_memory(
+        doc: fitz.Document,
+        pdf_path: str,
+        max_rss_mb: Union[int, None]
+    ) -> fitz.Document:
+    """ Returns the document, where the resident set is over max_rss_mb
+    the MuPDF store is emptied and, if still over, the document reopened
+    to drop its parsed objects """
+    if not max_rss_mb or instrument.rss_mb() <= max_rss_mb:
+        return doc
+    fitz.TOOLS.store_shrink(100)
+    if instrument.rss_mb() <= max_rss_mb:
+        return doc
+    doc.close()
+    report.count('documents_reopened')
+    return fitz.Document(pdf_path)
+
+def extract_pages(
+        pdf_path: str,
+        images: List[Tuple[int, int]],
+        progress: bool = True,
+        known: Union[set, None] = None,
+        done: Union[dict, None] = None,
+        max_rss_mb: Union[int, None] = None
+    ) -> Tuple[list, list]:
+    """ Save the images in the (page, xref) plan from plan_images
+
+    Where a set of known digests is given, images processed on a previous
+    run are skipped. Where done is given, images whose file name maps to
+    their current digest were extracted by an interrupted run and are
+    skipped too. Each pixmap is released once saved, and every
+    MEMORY_CHECK_INTERVAL images the resident set is held under
+    max_rss_mb. Returns the (file name, digest) pairs extracted and the
+    digests skipped.
+    """
+    file_name = os.path.basename(pdf_path)
+    save_path = os.path.join(WORKDIR, IMAGES)
+    extracted, skipped = [], []
+    doc = fitz.Document(pdf_path)
+    try:
+        for count, (i, xref) in enumerate(tqdm(images, desc="images", disable=not progress)):
+            if count % MEMORY_CHECK_INTERVAL == 0:
+                doc = check_memory(doc, pdf_path, max_rss_mb)
+
+            digest = None
+            if known is not None or done is not None:
+                digest = xref_digest(doc, xref)
+            if known is not None and digest in known:
+                skipped.append(digest)
+                continue
+
+            tmp_filename = f'{file_name[:-4]}_p{i}-{xref}.png'
+            if done is not None and done.get(tmp_filename) == digest:
+                continue
+            full_path = os.path.join(save_path, tmp_filename)
+
+            pix = png_ready(fitz.Pixmap(doc, xref))
+            try:
+                pix.save(full_path)
+            finally:
+                del pix
+            extracted.append((tmp_filename, digest))
+    finally:
+        doc.close()
+    return extracted, skipped
+
+def update_manifest(
+        manifest: Union[Manifest, None],
+        extracted: list,
+        skipped: list,
+        ledger: Union[Ledger, None] = None
+    ) -> None:
+    """ Stage the extracted images and mark the skipped ones as seen """
+    report.count('images_extracted', len(extracted))
+    report.count('images_skipped', len(skipped))
+    if ledger:
+        for tmp_filename, digest in extracted:
+            ledger.finish(tmp_filename, 'extract', {'digest': digest}, digest)
+    if not manifest:
+        return
+    for digest in skipped:
+        manifest.is_known(digest)
+    for tmp_filename, digest in extracted:
+        manifest.stage(tmp_filename, digest)
+
+def extracted_jobs(ledger: Ledger) -> dict:
+    """ Digests by file name of the images extracted on earlier runs that
+    are still waiting in the image directory or have since been renamed """
+    renamed = ledger.outputs('rename')
+    return {
+        item: output['digest'] for item, output in ledger.outputs('extract').items()
+        if item in renamed or os.path.isfile(os.path.join(WORKDIR, IMAGES, item))
+    }
+
+@timed('strip_images')
+def strip_images(
+        all_pages: bool = False,
+        workers: int = 1,
+        incremental: bool = False,
+        use_ledger: bool = False,
+        max_rss_mb: Union[int, None] = None
+    ) -> None:
+    """ Strip all images and place in the image directory
+
+    The images are planned once per document, each xref under the first
+    page it appears on. With more than one worker the plan is sharded
+    across a process pool, each worker opening its own document handle
+    and holding its resident set under max_rss_mb. The files written are
+    identical to the serial path. In incremental mode images already in
+    the manifest are not extracted again. With the ledger, images
+    extracted by an interrupted run are not extracted again.
+    """
+
+    setup_dirs()
+    manifest = Manifest() if incremental else None
+    known = None
+    if manifest:
+        manifest.start_run()
+        known = manifest.digests()
+    ledger = Ledger() if use_ledger else None
+    done = extracted_jobs(ledger) if ledger else None
 
     for each_path in os.listdir(WORKDIR):
         if ".pdf" in each_path:
-            doc = fitz.Document((os.path.join(WORKDIR, each_path)))
-            if all_pages:
-                rng = range(len(doc))
-            else:
-                rng = range(START_PAGE, END_PAGE)
-            for i in tqdm(rng, desc="pages"):
-                for img in tqdm(doc.get_page_images(i), desc="page_images"):
+            pdf_path = os.path.join(WORKDIR, each_path)
+            with fitz.Document(pdf_path) as doc:
+                images = plan_images(doc, get_page_range(doc, all_pages))
 
-                    xref = img[0]
+            if workers <= 1 or len(images) < 2:
+                extracted = extract_pages(pdf_path, images, True, known, done, max_rss_mb)
+                update_manifest(manifest, *extracted, ledger)
+                continue
 
-                    save_path = os.path.join(WORKDIR, IMAGES)
-                    tmp_filename = f'{each_path[:-4]}_p{i}-{xref}.png'
-                    full_path = os.path.join(save_path, tmp_filename)
+            shards = shard_pages(images, workers)
+            with ProcessPoolExecutor(max_workers=len(shards)) as pool:
+                futures = [
+                    pool.submit(extract_pages, pdf_path, shard, False, known, done, max_rss_mb)
+                    for shard in shards
+                ]
+                for future in tqdm(as_completed(futures), total=len(futures), desc="shards"):
+                    update_manifest(manifest, *future.result(), ledger)
 
-                    pix = fitz.Pixmap(doc, xref)
-                    pix.save(full_path)
+    print(f'Peak RSS MB: {instrument.peak_rss_mb()}')
+    if manifest:
+        manifest.save()
 
 def move_folder(full_path: str, file_path: str, folder: str = FAILED) -> None:
     """ Move to the specified folder """
     os.rename(full_path, os.path.join(WORKDIR, folder, file_path))
 
-def update_created_datetime(file_name: str, table_a: TableA) -> None:
+def update_created_datetime(file_name: str, table_a: TableA, folder: str = PROCESSED) -> None:
     """ Update the created datetime """
-    full_path = os.path.join(WORKDIR, PROCESSED, file_name)
+    full_path = os.path.join(WORKDIR, folder, file_name)
     dtime = datetime.datetime.strptime(table_a.updated, '%d/%m/%Y')
     os.utime(full_path, (dtime.timestamp(), dtime.timestamp()))
     print(full_path)
 
+def processed_date(file_name: str, folder: str = PROCESSED) -> datetime.date:
+    """ The updated date of a processed drawing, held as its modified time """
+    full_path = os.path.join(WORKDIR, folder, file_name)
+    return datetime.date.fromtimestamp(os.path.getmtime(full_path))
+
 def does_file_exist(file_name: str, folder: str = PROCESSED) -> bool:
     """ Returns True is the filename already exists """
     full_path = os.path.join(WORKDIR, folder, file_name)
     return os.path.isfile(full_path)
 
-def rename_images() -> None:
-    """ Renames all table A images """
-    for each_path in os.listdir(os.path.join(WORKDIR, IMAGES)):
+def existing_folder(file_name: str) -> Union[str, None]:
+    """ The folder holding the drawing of that name, processed or, where
+    read from the text layer this run, meta. None where there is none """
+    if does_file_exist(file_name):
+        return PROCESSED
+    if file_name in Streamed and does_file_exist(file_name, data_extract.META):
+        return data_extract.META
+    return None
+
+def load_image(full_path: str) -> np.ndarray:
+    """ Decode the image as an RGB array """
+    return cv2.cvtColor(cv2.imread(full_path), cv2.COLOR_BGR2RGB)
+
+def crop_region(image: np.ndarray, region: Region, scale: float = ROI_SCALE) -> np.ndarray:
+    """ Crop the region from the image, downscaling where required """
+    height, width = image.shape[:2]
+    crop = image[
+        int(region.top * height):int(region.bottom * height),
+        int(region.left * width):int(region.right * width)
+    ]
+    if scale != 1:
+        crop = cv2.resize(crop, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return crop
+
+def has_title_fields(values: list) -> bool:
+    """ Returns True if the LOR label, LOR code, sequence and date are all present """
+    return all(parse_fields(values))
+
+def ocr(image: Union[str, np.ndarray]) -> list:
+    """ Run the reader over a single image """
+    report.count('ocr_calls')
+    with report.stage('ocr'):
+        return get_reader().readtext(image, detail=1, **readtext_kw(BACKEND))
+
+def readtext(image: Union[str, np.ndarray]) -> list:
+    """ OCR an image path or array, using the cached result where available """
+    if not USE_CACHE:
+        return ocr(image)
+    return get_cache().fetch(image, ocr_params(), lambda: ocr(image))
+
+def read_title_block(image: np.ndarray, scale: float = ROI_SCALE) -> list:
+    """ OCR the title block regions only """
+    values = []
+    for region in TITLE_BLOCK:
+        values += readtext(crop_region(image, region, scale))
+    return values
+
+def read_array(image: np.ndarray, roi: bool = False, scale: float = ROI_SCALE) -> list:
+    """ OCR a decoded image, trying the title block regions first in roi
+    mode and falling back to the full page when the fields don't validate """
+    if roi:
+        values = read_title_block(image, scale)
+        if has_title_fields(values):
+            return values
+    return readtext(image)
+
+def read_image(full_path: str, roi: bool = False, scale: float = ROI_SCALE) -> list:
+    """ OCR the image file """
+    if not roi:
+        return readtext(full_path)
+    return read_array(load_image(full_path), roi, scale)
+
+def title_thumbnail(image: np.ndarray, scale: float = ROI_SCALE) -> np.ndarray:
+    """ The gray title block held in the perceptual hash index """
+    crop = crop_region(image, TITLE_BLOCK[0], scale)
+    return crop if crop.ndim == 2 else cv2.cvtColor(crop, cv2.COLOR_RGB2GRAY)
+
+def load_thumbnail(full_path: str) -> np.ndarray:
+    """ Decode the title block thumbnail of the image file """
+    return title_thumbnail(cv2.imread(full_path, cv2.IMREAD_GRAYSCALE))
+
+def find_duplicate(each_path: str, thumb: np.ndarray, pending: bool = False) -> Union[dict, None]:
+    """ Returns the earlier OCR result and destination of a drawing with a
+    near identical title block, otherwise indexes the image ahead of OCR.
+    With pending, a match still awaiting OCR is returned with no result """
+    match = get_hashes().find(thumb, pending)
+    if not match:
+        get_hashes().add(each_path, thumb)
+    elif match['result'] is not None:
+        print(f'{each_path} duplicate of {match["item"]}, reusing its OCR result')
+        report.count('images_duplicate')
+    return match
+
+def read_or_reuse(full_path: str, roi: bool = False) -> Tuple[list, Union[str, None]]:
+    """ OCR the image file, with DEDUPE reusing the result of a duplicate.
+    Returns the result and the file name of the duplicate, if any """
+    if DEDUPE:
+        match = find_duplicate(os.path.basename(full_path), load_thumbnail(full_path))
+        if match:
+            return match['result'], match['file_name']
+    return read_image(full_path, roi), None
+
+def evaluate_prefilter() -> dict:
+    """ Compare the prefilter against full OCR on the image directory,
+    nothing is moved. Table A drawings are the positive class """
+    counts = {'tp': 0, 'fp': 0, 'fn': 0, 'tn': 0}
+    for each_path in sorted(os.listdir(os.path.join(WORKDIR, IMAGES))):
         full_path = os.path.join(WORKDIR, IMAGES, each_path)
-        if ".png" in each_path:
-            result = reader.readtext(full_path, detail=0)
+        if ".png" not in each_path:
+            continue
+        predicted = prefilter(full_path) is None
+        actual = parse_fields(readtext(full_path)).label
+        if predicted:
+            counts['tp' if actual else 'fp'] += 1
+        else:
+            counts['fn' if actual else 'tn'] += 1
 
-            if not 'LOR' in result:
-                print(f'{each_path} not Table A drawing')
-                move_folder(full_path, each_path, FAILED)
-                continue
+    passed = counts['tp'] + counts['fp']
+    drawings = counts['tp'] + counts['fn']
+    summary = {
+        **counts,
+        'precision': counts['tp'] / passed if passed else 0.0,
+        'recall': counts['tp'] / drawings if drawings else 1.0,
+        'ocr_calls': f'{passed}/{sum(counts.values())}'
+    }
+    print(summary)
+    return summary
 
-            try:
-                table_a = TableA(
-                    each_path,
-                    get_lor(result).replace('O', '0'),
-                    get_seq(result).replace('O', '0'),
-                    get_updated_date(result)
-                )
-            except AttributeError:
-                move_folder(full_path, each_path, FAILED)
-                print(result)
-                continue
+def decode_images(paths: List[str], prefetch: int = 2 * BATCH_SIZE) -> Iterator[tuple]:
+    """ Decode images on a thread pool, yields (path, image) in order
+    with at most prefetch images held in memory """
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+        for full_path in paths:
+            pending.append((full_path, pool.submit(load_image, full_path)))
+            if len(pending) >= prefetch:
+                full_path, future = pending.popleft()
+                yield full_path, future.result()
+        while pending:
+            full_path, future = pending.popleft()
+            yield full_path, future.result()
+
+def recognise_batch(batch: List[tuple], batch_size: int = BATCH_SIZE) -> Iterator[tuple]:
+    """ OCR a batch of equally sized images, yields (path, values) """
+    paths, images, keys = zip(*batch)
+    report.count('ocr_calls', len(images))
+    report.count('ocr_batches')
+    with report.stage('ocr_batch'):
+        results = get_reader().readtext_batched(
+            list(images), detail=1, batch_size=batch_size, **readtext_kw(BACKEND)
+        )
+    for key, result in zip(keys, results):
+        if key:
+            get_cache().put(key, result)
+    yield from zip(paths, results)
+
+def read_batched(
+        paths: List[str],
+        batch_size: int = BATCH_SIZE,
+        roi: bool = False,
+        scale: float = ROI_SCALE
+    ) -> Iterator[tuple]:
+    """ OCR the images in fixed size batches, yields (path, values)
 
-            if not all(table_a):
-                move_folder(full_path, each_path, FAILED)
-                print(result)
+    Images are grouped by shape as EasyOCR requires each batch to share
+    dimensions. In roi mode the title block is tried first and only the
+    images that fail validation are queued for full page OCR.
+    """
+    buckets = {}
+    for full_path, image in decode_images(paths, 2 * batch_size):
+        if roi:
+            values = read_title_block(image, scale)
+            if has_title_fields(values):
+                yield full_path, values
                 continue
+        key = None
+        if USE_CACHE:
+            key = get_cache().make_key(image, ocr_params())
+            values = get_cache().get(key)
+            if values is not None:
+                yield full_path, values
+                continue
+        bucket = buckets.setdefault(image.shape, [])
+        bucket.append((full_path, image, key))
+        if len(bucket) >= batch_size:
+            yield from recognise_batch(buckets.pop(image.shape), batch_size)
+    for bucket in buckets.values():
+        yield from recognise_batch(bucket, batch_size)
+
+def resolve_collision(
+        each_path: str,
+        table_a: TableA,
+        new_file_name: str,
+        folder: str = PROCESSED
+    ) -> Tuple[str, str, Union[TableA, None]]:
+    """ Apply COLLISION_POLICY to a drawing resolving to the LOR-SEQ of a
+    different drawing already processed, held in folder
+
+    - review: the drawing goes to the review directory, prefixed with the LOR-SEQ
+    - newest: the drawing with the later updated date keeps the name, the
+      other goes to failed, suffixed with its date where it was processed
+    - suffix: both are kept, the drawing as LOR-SEQ_2, _3 and so on
+    """
+    if COLLISION_POLICY == 'suffix':
+        number = 2
+        while existing_folder(f'{new_file_name[:-4]}_{number}.png'):
+            number += 1
+        print(f'File already exist: {new_file_name}, kept as {new_file_name[:-4]}_{number}.png')
+        report.count('collisions_suffixed')
+        return PROCESSED, f'{new_file_name[:-4]}_{number}.png', table_a
+
+    if COLLISION_POLICY == 'newest':
+        current = processed_date(new_file_name, folder)
+        if datetime.datetime.strptime(table_a.updated, '%d/%m/%Y').date() > current:
+            superseded = f'{new_file_name[:-4]}_{current:%Y%m%d}.png'
+            print(f'{each_path} supersedes {new_file_name}, moved to {FAILED}/{superseded}')
+            move_folder(os.path.join(WORKDIR, folder, new_file_name), superseded, FAILED)
+            report.count('collisions_superseded')
+            return PROCESSED, new_file_name, table_a
+        print(f'{each_path} superseded by {new_file_name}')
+        report.reject('superseded')
+        return FAILED, each_path, None
+
+    print(f'File already exist: {new_file_name}, {each_path} moved to {REVIEW}')
+    report.reject('collision')
+    return REVIEW, f'{new_file_name[:-4]}_{each_path}', None
+
+def get_destination(
+        each_path: str,
+        result: list,
+        duplicate_of: Union[str, None] = None
+    ) -> Tuple[str, str, Union[TableA, None]]:
+    """ Returns the folder, file name and Table A record for an OCR result.
+    duplicate_of is the file name given to a near identical drawing, a
+    duplicate of the drawing still in the processed directory under that
+    name and date is rejected, any other drawing resolving to an existing
+    LOR-SEQ is a collision """
+
+    fields = parse_fields(result)
+    if not fields.label:
+        print(f'{each_path} not Table A drawing')
+        report.reject('no LOR label')
+        return FAILED, each_path, None
+
+    if not fields.lor or not fields.seq:
+        print(result)
+        report.reject('fields not parsed')
+        return FAILED, each_path, None
+
+    if not fields.updated:
+        print('WARNING: Unable to parse date, using default')
+    table_a = TableA(each_path, fields.lor, fields.seq, fields.updated or DEFAULT_DATE)
 
-            print(table_a)
-            new_file_name = format_filename(table_a)
+    print(table_a)
+    new_file_name = format_filename(table_a)
 
-            if does_file_exist(new_file_name):
-                move_folder(full_path, each_path, FAILED)
-                print(f'File already exist: {new_file_name}')
+    folder = existing_folder(new_file_name)
+    if folder:
+        updated = datetime.datetime.strptime(table_a.updated, '%d/%m/%Y').date()
+        if duplicate_of == new_file_name and processed_date(new_file_name, folder) == updated:
+            print(f'File already exist: {new_file_name}')
+            report.reject('duplicate')
+            return FAILED, each_path, None
+        return resolve_collision(each_path, table_a, new_file_name, folder)
+
+    report.count('images_accepted')
+    return PROCESSED, new_file_name, table_a
+
+def record_outcome(
+        manifest: Union[Manifest, None],
+        tmp_filename: str,
+        file_name: Union[str, None]
+    ) -> None:
+    """ Record the LOR-SEQ an image resolved to in the manifest, taken from
+    the file name it was saved under so a suffixed copy is tracked apart.
+    file_name is None where the image was rejected """
+    if manifest:
+        manifest.record(tmp_filename, file_name[:-4] if file_name else None)
+
+def apply_rename(
+        full_path: str,
+        output: dict,
+        manifest: Union[Manifest, None] = None
+    ) -> None:
+    """ Move the image to the destination in the rename output """
+    table_a = TableA(*output['table_a']) if output['table_a'] else None
+    move_folder(full_path, output['file_name'], output['folder'])
+    if table_a:
+        update_created_datetime(output['file_name'], table_a)
+    record_outcome(manifest, os.path.basename(full_path), output['file_name'] if table_a else None)
+
+def rename_image(
+        full_path: str,
+        result: list,
+        manifest: Union[Manifest, None] = None,
+        ledger: Union[Ledger, None] = None,
+        duplicate_of: Union[str, None] = None
+    ) -> None:
+    """ Rename a single image from its OCR result, committing the outcome
+    to the ledger ahead of the move """
+    each_path = os.path.basename(full_path)
+    folder, file_name, table_a = get_destination(each_path, result, duplicate_of)
+    if DEDUPE and not duplicate_of:
+        get_hashes().record(each_path, result, file_name)
+    output = {'folder': folder, 'file_name': file_name, 'table_a': table_a}
+    if ledger:
+        ledger.finish(each_path, 'rename', output, file_key(full_path))
+    apply_rename(full_path, output, manifest)
+
+@timed('rename_images')
+def rename_images(
+        use_prefilter: bool = True,
+        roi: bool = False,
+        batch_size: int = 1,
+        incremental: bool = False,
+        use_ledger: bool = False
+    ) -> None:
+    """ Renames all table A images
+
+    A batch_size above one decodes images on a thread pool and runs
+    them through EasyOCR in batches rather than one file at a time.
+    In incremental mode the outcome is recorded in the manifest and
+    the new, changed and removed drawings are written to the delta report.
+    With the ledger, images an interrupted run had already renamed are
+    moved from the recorded outcome without OCR. With DEDUPE, drawings
+    whose title block matches one OCR'd before reuse its result.
+    """
+    setup_dirs()
+    manifest = Manifest() if incremental else None
+    ledger = Ledger() if use_ledger else None
+    candidates = []
+    for each_path in os.listdir(os.path.join(WORKDIR, IMAGES)):
+        full_path = os.path.join(WORKDIR, IMAGES, each_path)
+        if ".png" in each_path:
+            output = ledger.get(each_path, 'rename', file_key(full_path)) if ledger else None
+            if output:
+                report.count('images_resumed')
+                apply_rename(full_path, output, manifest)
                 continue
+            if use_prefilter:
+                reason = prefilter(full_path)
+                if reason:
+                    print(f'{each_path} not Table A drawing: {reason}')
+                    report.reject(reason)
+                    move_folder(full_path, each_path, FAILED)
+                    record_outcome(manifest, each_path, None)
+                    continue
+            candidates.append(full_path)
+
+    if batch_size > 1:
+        # Repeats of a drawing in the same batch wait for its OCR result
+        unique, repeats = [], []
+        for full_path in candidates:
+            match = None
+            if DEDUPE:
+                thumb = load_thumbnail(full_path)
+                match = find_duplicate(os.path.basename(full_path), thumb, pending=True)
+            if not match:
+                unique.append(full_path)
+            elif match['result'] is None:
+                repeats.append(full_path)
+            else:
+                rename_image(full_path, match['result'], manifest, ledger, match['file_name'])
+        for full_path, result in read_batched(unique, batch_size, roi):
+            rename_image(full_path, result, manifest, ledger)
+        candidates = repeats
+
+    for full_path in candidates:
+        result, duplicate_of = read_or_reuse(full_path, roi)
+        rename_image(full_path, result, manifest, ledger, duplicate_of)
+
+    if USE_CACHE:
+        print(f'OCR cache: {get_cache().stats()}')
+        report.set('ocr_cache', get_cache().stats())
+    if ledger:
+        print(f'Ledger: {ledger.summary()}')
+    if manifest:
+        manifest.finish_run()
+        manifest.save()
+
+def read_text_layer(tmp_filename: str, words: List[text_layer.Word]) -> Union[tuple, None]:
+    """ Returns the folder, file name, Table A record and table record read
+    from the page text layer, None where the title fields fail validation.
+    The table record is None where the table must still be OCR'd """
+    title_tokens = text_layer.as_tokens(words)
+    if not all(parse_fields(title_tokens)):
+        return None
+
+    report.count('text_layer_titles')
+    folder, file_name, table_a = get_destination(tmp_filename, title_tokens)
+    if not table_a:
+        return folder, file_name, table_a, None
+
+    record = data_extract.parse_values(text_layer.read_table(words))
+    if not data_extract.is_complete(*record):
+        return folder, file_name, table_a, None
+    report.count('text_layer_records')
+    return data_extract.META, file_name, table_a, record
+
+def write_text_records(
+        rows: List[tuple],
+        manifest: Union[Manifest, None] = None,
+        ledger: Union[Ledger, None] = None
+    ) -> None:
+    """ Write the rows read from the text layer to the data_extract output.
+    In incremental mode the rows of changed drawings are replaced, with the
+    ledger the rows of drawings resumed from an interrupted run are too """
+    if not rows:
+        return
+    # A drawing superseded under the newest policy leaves its row behind
+    rows = list({row[0]: row for row in rows}.values())
+    if manifest or ledger:
+        data_extract.prune_tsv([row[0][:-4] for row in rows])
+    with RecordWriter(data_extract.TSV) as writer:
+        writer.write_many(rows)
+
+def skip_streamed(
+        tmp_filename: str,
+        digest: Union[str, None],
+        manifest: Union[Manifest, None],
+        ledger: Union[Ledger, None],
+        rows: List[tuple]
+    ) -> bool:
+    """ True where the image is unchanged since the manifest run, or was
+    saved by an interrupted run. The row of a resumed text layer drawing
+    is added to rows """
+    if manifest:
+        if manifest.is_known(digest):
+            return True
+        manifest.stage(tmp_filename, digest)
+    output = ledger.get(tmp_filename, 'stream', digest) if ledger else None
+    if not output:
+        return False
+
+    report.count('images_resumed')
+    record_outcome(manifest, tmp_filename, output['file_name'] if output['table_a'] else None)
+    if output['folder'] == data_extract.META:
+        Streamed.add(output['file_name'])
+        saved = ledger.get(output['file_name'], 'data_extract')
+        if saved:
+            rows.append(tuple(saved['row']))
+    return True
+
+def reject_pixmap(pix: fitz.Pixmap, tmp_filename: str) -> Union[tuple, None]:
+    """ Returns the failed destination where the prefilter rejects the image """
+    reason = check_size(pix.width, pix.height)
+    if not reason:
+        return None
+    print(f'{tmp_filename} not Table A drawing: {reason}')
+    report.reject(reason)
+    return FAILED, tmp_filename, None, None
+
+def stream_destination(
+        pix: fitz.Pixmap,
+        tmp_filename: str,
+        words: Union[List[text_layer.Word], None],
+        roi: bool
+    ) -> tuple:
+    """ Returns the folder, file name, Table A record and table record for
+    the image, read from the text layer where it validates, else by OCR """
+    found = read_text_layer(tmp_filename, words) if words else None
+    if found:
+        return found
+
+    image = pixmap_to_array(pix)
+    match = find_duplicate(tmp_filename, title_thumbnail(image)) if DEDUPE else None
+    if match:
+        result, duplicate_of = match['result'], match['file_name']
+    else:
+        result, duplicate_of = read_array(image, roi), None
+    folder, file_name, table_a = get_destination(tmp_filename, result, duplicate_of)
+    if DEDUPE and not duplicate_of:
+        get_hashes().record(tmp_filename, result, file_name)
+    return folder, file_name, table_a, None
+
+def save_streamed(
+        pix: fitz.Pixmap,
+        tmp_filename: str,
+        digest: Union[str, None],
+        destination: tuple,
+        manifest: Union[Manifest, None],
+        ledger: Union[Ledger, None]
+    ) -> Union[tuple, None]:
+    """ Write the image to its destination and commit the outcome, returns
+    the data_extract row of a drawing read from the text layer """
+    folder, file_name, table_a, record = destination
+    pix.save(os.path.join(WORKDIR, folder, file_name))
+    if folder == data_extract.META:
+        Streamed.add(file_name)
+    if table_a:
+        update_created_datetime(file_name, table_a, folder)
+    row = data_extract.make_row(file_name, *record) if record else None
+    record_outcome(manifest, tmp_filename, file_name if table_a else None)
+    if ledger:
+        if row:
+            ledger.finish(file_name, 'data_extract', {'row': row, 'folder': data_extract.META})
+        output = {'folder': folder, 'file_name': file_name, 'table_a': table_a}
+        ledger.finish(tmp_filename, 'stream', output, digest)
+    return row
+
+@timed('stream_images')
+def stream_images(
+        all_pages: bool = False,
+        use_prefilter: bool = True,
+        roi: bool = False,
+        incremental: bool = False,
+        use_text_layer: bool = False,
+        use_ledger: bool = False,
+        max_rss_mb: Union[int, None] = None
+    ) -> None:
+    """ Extract, OCR and rename in memory
+
+    Each pixmap is viewed as an array for OCR and written to disk once,
+    under its final name in the processed directory or to failed. Images
+    shared between pages are processed once, under the first page, and
+    the resident set is held under max_rss_mb as in extract_pages.
+
+    With use_text_layer, pages holding a single image are first read from
+    the PDF text layer. Drawings whose title and table both validate skip
+    OCR and data_extract entirely: the image goes straight to meta and the
+    row to the data_extract output. OCR is used for everything else.
+
+    With the ledger, images saved by an interrupted run are skipped. The
+    row of a text layer drawing is committed to the ledger along with its
+    image, and written out again from there when resumed.
+    """
+
+    setup_dirs()
+    Streamed.clear()
+    if use_text_layer:
+        data_extract.setup_dirs()
+    manifest = Manifest() if incremental else None
+    if manifest:
+        manifest.start_run()
+    ledger = Ledger() if use_ledger else None
+
+    rows = []
+    for each_path in os.listdir(WORKDIR):
+        if ".pdf" not in each_path:
+            continue
+        pdf_path = os.path.join(WORKDIR, each_path)
+        doc = fitz.Document(pdf_path)
+        seen = set()
+        try:
+            for i in tqdm(get_page_range(doc, all_pages), desc="pages"):
+                if i % MEMORY_CHECK_INTERVAL == 0:
+                    doc = check_memory(doc, pdf_path, max_rss_mb)
+                images = doc.get_page_images(i)
+                words = None
+                if use_text_layer and len(images) == 1:
+                    words = text_layer.page_words(doc[i])
+
+                for img in images:
+                    xref = img[0]
+                    if xref in seen:
+                        report.count('images_shared')
+                        continue
+                    seen.add(xref)
+                    tmp_filename = f'{each_path[:-4]}_p{i}-{xref}.png'
+                    digest = xref_digest(doc, xref) if manifest or ledger else None
+                    if skip_streamed(tmp_filename, digest, manifest, ledger, rows):
+                        continue
+
+                    pix = pixmap_to_rgb(fitz.Pixmap(doc, xref))
+                    destination = reject_pixmap(pix, tmp_filename) if use_prefilter else None
+                    if not destination:
+                        destination = stream_destination(pix, tmp_filename, words, roi)
+                    row = save_streamed(pix, tmp_filename, digest, destination, manifest, ledger)
+                    del pix
+                    if row:
+                        rows.append(row)
+        finally:
+            doc.close()
+
+    write_text_records(rows, manifest, ledger)
+    print(f'Peak RSS MB: {instrument.peak_rss_mb()}')
+    if USE_CACHE:
+        print(f'OCR cache: {get_cache().stats()}')
+        report.set('ocr_cache', get_cache().stats())
+    if ledger:
+        print(f'Ledger: {ledger.summary()}')
+    if manifest:
+        manifest.finish_run()
+        manifest.save()
+
+def main(argv: Union[List[str], None] = None) -> None:
+    """ Entrypoint """
+    global BACKEND, TORCH_THREADS, USE_CACHE, DEDUPE, COLLISION_POLICY  # pylint: disable=W0603
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--page-range', action='store_true',
+                        help=f'only pages {START_PAGE} to {END_PAGE}, default is all pages')
+    parser.add_argument('--workers', type=int, default=WORKERS, help='extraction processes')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='images per OCR batch')
+    parser.add_argument('--roi', action='store_true', help='OCR the title block first')
+    parser.add_argument('--no-prefilter', action='store_true', help='OCR every image')
+    parser.add_argument('--stream', action='store_true',
+                        help='OCR in memory, no intermediate PNGs')
+    parser.add_argument('--text-layer', action='store_true',
+                        help='read the PDF text layer first, OCR only where it fails '
+                        '(implies --stream)')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only process images not seen on a previous run')
+    parser.add_argument('--backend', choices=BACKENDS, default=BACKEND, help='OCR backend')
+    parser.add_argument('--threads', type=int, default=TORCH_THREADS,
+                        help='torch threads for the easyocr backends')
+    parser.add_argument('--no-cache', action='store_true', help='bypass the OCR cache')
+    parser.add_argument('--no-dedupe', action='store_true',
+                        help='OCR every drawing, even a repeat of one seen before')
+    parser.add_argument('--collisions', choices=COLLISION_POLICIES, default=COLLISION_POLICY,
+                        help='drawings resolving to an existing LOR-SEQ go to review/, keep the '
+                        'newest by updated date, or are kept with a _2 suffix')
+    parser.add_argument('--profile', action='store_true', help='cProfile each stage into reports/')
+    parser.add_argument('--ledger', action='store_true',
+                        help='record each image in ledger.sqlite, resuming an interrupted run')
+    parser.add_argument('--max-rss-mb', type=int, default=None,
+                        help='memory ceiling for each extraction process, the PDF is '
+                        'reopened with the MuPDF store emptied when over it')
+    parser.add_argument('--evaluate-prefilter', action='store_true',
+                        help='extract the images and report the prefilter against full OCR, '
+                        'nothing is renamed or moved')
+    args = parser.parse_args(argv)
+
+    BACKEND, TORCH_THREADS, USE_CACHE = args.backend, args.threads, not args.no_cache
+    DEDUPE, COLLISION_POLICY = not args.no_dedupe, args.collisions
+    instrument.PROFILE = args.profile
 
-            move_folder(full_path, new_file_name, PROCESSED)
-            update_created_datetime(new_file_name, table_a)
+    all_pages = not args.page_range
+    if (args.stream or args.text_layer) and not args.evaluate_prefilter:
+        stream_images(
+            all_pages, not args.no_prefilter, args.roi,
+            args.incremental, args.text_layer, args.ledger, args.max_rss_mb
+        )
+    else:
+        strip_images(all_pages, args.workers, args.incremental, args.ledger, args.max_rss_mb)
+        if args.evaluate_prefilter:
+            evaluate_prefilter()
+        else:
+            rename_images(
+                not args.no_prefilter, args.roi, args.batch_size, args.incremental, args.ledger
+            )
+    report.write('rip')
 
 if __name__ == "__main__":
-    strip_images(all_pages=True)
-    rename_images()
+    main()
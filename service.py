@@ -0,0 +1,260 @@
+""" Long running service: watch the working directory and push new PDFs
+and drawings through strip, rename, extract and geotag
+
+The OCR readers and the milepost index are loaded once and kept warm,
+so a late notice supplement dropped into the working directory is
+processed in seconds. Each stage has its own queue and executor:
+
+- strip runs on a process pool, PyMuPDF is not thread safe
+- rename and extract each run on a single thread, the OCR readers and
+  their caches are used from the thread that created them
+- geotag converts and tags images on a thread pool
+
+Drawings dropped straight into images/ or processed/ are picked up too.
+The PDFs already stripped are recorded in the job ledger so a restart
+only processes new or replaced PDFs.
+Records that fail validation are left in failed_meta for update_failed
+as usual, only complete records with a known ELR are geotagged.
+"""
+
+# pylint: disable=E0401, W0718
+
+import argparse
+import asyncio
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Dict, List, Union
+import fitz
+import numpy as np
+
+import rip
+import data_extract
+import geotag
+from instrument import report
+from ledger import Ledger
+from mp_index import MilepostIndex
+from record_writer import RecordWriter
+
+POLL_SECONDS = 2.0
+STAGES = ['strip', 'rename', 'extract', 'geotag']
+TAGGED_COLUMNS = geotag.TSV_HEADER + ['lon', 'lat', 'parent', 'err']
+
+def strip_pdf(pdf_path: str) -> List[str]:
+    """ Extract every image in the PDF, returns the file names written """
+    with fitz.Document(pdf_path) as doc:
+        images = rip.plan_images(doc, range(len(doc)))
+    extracted, _ = rip.extract_pages(pdf_path, images, progress=False)
+    return [tmp_filename for tmp_filename, _ in extracted]
+
+def signature(path: str) -> str:
+    """ Size and modified time, a PDF is processed again when either changes """
+    stat = os.stat(path)
+    return f'{stat.st_size}-{stat.st_mtime_ns}'
+
+def list_png(folder: str) -> List[str]:
+    """ The PNG files in the folder """
+    if not os.path.isdir(folder):
+        return []
+    return [
+        os.path.join(folder, name) for name in sorted(os.listdir(folder)) if name.endswith('.png')
+    ]
+
+def item_name(item: Union[str, tuple]) -> str:
+    """ The path of a queued file, or the file name of a queued record """
+    return item if isinstance(item, str) else item[0]
+
+class Service:
+    """ Directory watcher feeding a queue per stage """
+
+    def __init__(
+            self,
+            strip_workers: int = 1,
+            geotag_workers: int = geotag.WORKERS,
+            roi: bool = False,
+            poll: float = POLL_SECONDS,
+            use_prefilter: bool = True
+        ):
+        """ Initialisation """
+        self.roi = roi
+        self.use_prefilter = use_prefilter
+        self.poll = poll
+        self.workers = {'strip': strip_workers, 'rename': 1, 'extract': 1, 'geotag': geotag_workers}
+        self.executors: Dict[str, Executor] = {
+            'strip': ProcessPoolExecutor(max_workers=strip_workers),
+            'rename': ThreadPoolExecutor(max_workers=1),
+            'extract': ThreadPoolExecutor(max_workers=1),
+            'geotag': ThreadPoolExecutor(max_workers=geotag_workers)
+        }
+        self.queues: Dict[str, asyncio.Queue] = {}
+        self.inflight = set()
+        self.failed = {}
+        self.pdfs = {}
+        self.ledger: Union[Ledger, None] = None
+        self.index: Union[MilepostIndex, None] = None
+
+    async def run_in(self, stage: str, func: Callable, *args):
+        """ Run the blocking function on the stage executor """
+        return await asyncio.get_running_loop().run_in_executor(self.executors[stage], func, *args)
+
+    async def warm(self) -> None:
+        """ Create the working directories and load the readers and index """
+        rip.setup_dirs()
+        data_extract.setup_dirs()
+        geotag.setup_dirs()
+        self.ledger = Ledger()
+        self.pdfs = {pdf: output['signature'] for pdf, output in self.ledger.outputs('pdf').items()}
+        with report.stage('warm'):
+            await asyncio.gather(
+                self.run_in('rename', rip.get_reader),
+                self.run_in('extract', data_extract.get_reader)
+            )
+            if os.path.isfile(geotag.MP_GEO):
+                self.index = MilepostIndex(geotag.MP_GEO)
+            else:
+                print(f'{geotag.MP_GEO} not found, geotagging is disabled')
+        print('Service ready')
+
+    def enqueue(self, stage: str, item) -> None:
+        """ Queue the item unless already queued, or failed with no change since """
+        key = (stage, item_name(item))
+        if key in self.inflight:
+            return
+        if isinstance(item, str) and self.failed.get(key) == signature(item):
+            return
+        self.inflight.add(key)
+        self.queues[stage].put_nowait(item)
+
+    def scan(self) -> None:
+        """ Queue the new PDFs and the drawings waiting in each directory """
+        for name in sorted(os.listdir(rip.WORKDIR)):
+            pdf_path = os.path.join(rip.WORKDIR, name)
+            if name.endswith('.pdf') and self.pdfs.get(pdf_path) != signature(pdf_path):
+                self.enqueue('strip', pdf_path)
+        for full_path in list_png(os.path.join(rip.WORKDIR, rip.IMAGES)):
+            self.enqueue('rename', full_path)
+        for full_path in list_png(data_extract.PATH):
+            self.enqueue('extract', full_path)
+
+    async def strip(self, pdf_path: str) -> None:
+        """ Extract the images, the watcher queues them for rename """
+        current = signature(pdf_path)
+        extracted = await self.run_in('strip', strip_pdf, pdf_path)
+        self.pdfs[pdf_path] = current
+        self.ledger.finish(pdf_path, 'pdf', {'signature': current, 'images': extracted})
+        report.count('images_extracted', len(extracted))
+        print(f'{pdf_path}: {len(extracted)} images extracted')
+
+    async def rename(self, full_path: str) -> None:
+        """ OCR the title block and rename, the watcher queues processed drawings """
+        def task():
+            each_path = os.path.basename(full_path)
+            reason = rip.prefilter(full_path) if self.use_prefilter else None
+            if reason:
+                print(f'{each_path} not Table A drawing: {reason}')
+                report.reject(reason)
+                rip.move_folder(full_path, each_path, rip.FAILED)
+                return
+            result, duplicate_of = rip.read_or_reuse(full_path, self.roi)
+            rip.rename_image(full_path, result, duplicate_of=duplicate_of)
+        await self.run_in('rename', task)
+
+    async def extract(self, full_path: str) -> None:
+        """ Extract the table, complete records are queued for geotagging """
+        def task():
+            record = data_extract.extract_record(full_path)
+            data_extract.save_record(full_path, *record)
+            return record
+        record = await self.run_in('extract', task)
+        if self.index and data_extract.is_complete(*record):
+            self.enqueue('geotag', (os.path.basename(full_path), *record))
+
+    async def tag(self, item: tuple) -> None:
+        """ Locate the drawing on its ELR, tag the image and append the row """
+        file_name, elr, mileages, description = item
+        if elr[0] not in self.index.slices:
+            print(f'{file_name}: ELR {elr[0]} not found in {geotag.MP_GEO}')
+            return
+        mileage = mileages[0]
+        values, lons, lats, parents = self.index.lookup(elr[0])
+        target = np.array([float(mileage.miles) + float(mileage.yards) / geotag.YARDS_PER_MILE])
+        lon, lat, nearest, err = geotag.GeoTag.interpolate(values, lons, lats, target)
+
+        await self.run_in('geotag', geotag.GeoTag.tag_file, file_name, float(lat[0]), float(lon[0]))
+        row = data_extract.make_row(file_name, elr, mileages, description)
+        row += (float(lon[0]), float(lat[0]), int(parents[nearest[0]]), round(float(err[0]), 1))
+        with RecordWriter(geotag.TAGGED, columns=TAGGED_COLUMNS) as writer:
+            writer.write(row)
+
+    async def worker(self, stage: str, func: Callable) -> None:
+        """ Take items from the stage queue until cancelled """
+        queue = self.queues[stage]
+        while True:
+            item = await queue.get()
+            try:
+                with report.stage(stage):
+                    await func(item)
+            except Exception as err:
+                print(f'{stage} failed for {item}: {err!r}')
+                report.reject(f'{stage} error')
+                if isinstance(item, str) and os.path.isfile(item):
+                    self.failed[(stage, item)] = signature(item)
+            finally:
+                self.inflight.discard((stage, item_name(item)))
+                queue.task_done()
+
+    def idle(self) -> bool:
+        """ Returns True if nothing is queued or running """
+        return not self.inflight
+
+    async def serve(self, once: bool = False) -> None:
+        """ Watch and process until cancelled, with once until idle """
+        self.queues = {stage: asyncio.Queue() for stage in STAGES}
+        await self.warm()
+        funcs = {
+            'strip': self.strip, 'rename': self.rename, 'extract': self.extract, 'geotag': self.tag
+        }
+        tasks = [
+            asyncio.create_task(self.worker(stage, funcs[stage]))
+            for stage in STAGES for _ in range(self.workers[stage])
+        ]
+        try:
+            while True:
+                self.scan()
+                if once and self.idle():
+                    break
+                await asyncio.sleep(self.poll)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for executor in self.executors.values():
+                executor.shutdown()
+
+def main(argv: Union[List[str], None] = None) -> None:
+    """ Entrypoint """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--poll', type=float, default=POLL_SECONDS, help='seconds between scans')
+    parser.add_argument('--strip-workers', type=int, default=1, help='PDF extraction processes')
+    parser.add_argument('--geotag-workers', type=int, default=geotag.WORKERS,
+                        help='image tagging threads')
+    parser.add_argument('--roi', action='store_true', help='OCR the title block first')
+    parser.add_argument('--backend', choices=rip.BACKENDS, default=rip.BACKEND, help='OCR backend')
+    parser.add_argument('--no-prefilter', action='store_true', help='OCR every image')
+    parser.add_argument('--once', action='store_true', help='exit once everything waiting is done')
+    args = parser.parse_args(argv)
+
+    rip.BACKEND = args.backend
+    # data_extract has no tesseract backend, it keeps its default there
+    if args.backend in data_extract.BACKENDS:
+        data_extract.BACKEND = args.backend
+    service = Service(
+        args.strip_workers, args.geotag_workers, args.roi, args.poll, not args.no_prefilter
+    )
+    try:
+        asyncio.run(service.serve(args.once))
+    except KeyboardInterrupt:
+        print('Stopped')
+    report.write('service')
+
+if __name__ == "__main__":
+    main()
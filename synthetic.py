@@ -0,0 +1,167 @@
+""" Generate synthetic Table A drawings, packed into a PDF, and a matching
+milepost GeoPackage so the pipeline can be benchmarked offline """
+
+# pylint: disable=E0401, C0415
+
+import io
+import os
+import random
+from collections import namedtuple
+from typing import List, Tuple
+import fitz
+from PIL import Image, ImageDraw, ImageFont
+
+import rip
+from title_fields import LOR
+
+Drawing = namedtuple('Drawing', 'lor, seq, date, route, elr, miles, chains')
+
+SIZE = (1684, 1190)
+PAGE_SIZE = (842, 595)
+# Resolution of the drawings once placed on the page
+DPI = 72 * SIZE[0] // PAGE_SIZE[0]
+TABLE_LEFT = 120
+TABLE_TOP = 80
+COLUMN_WIDTHS = [520, 240, 360]
+ROW_HEIGHT = 70
+FONT = 'DejaVuSans.ttf'
+CRS = 'EPSG:27700'
+METRES_PER_MILE = 1609.344
+POST_INTERVAL = 0.25
+ELR_LENGTH = 60
+ELRS = ['MLN1', 'DCL', 'BFO', 'SWM2', 'ECM1', 'LEC', 'NTL', 'CGJ2']
+ROUTES = [
+    'Paddington to Reading',
+    'Didcot to Chester Line',
+    'Bristol to Exeter',
+    'Kings Cross to Doncaster',
+    'Leeds to Carlisle',
+    'Crewe to Glasgow'
+]
+
+def font(size: int) -> ImageFont.FreeTypeFont:
+    """ The drawing font, falling back to the Pillow default """
+    try:
+        return ImageFont.truetype(FONT, size)
+    except OSError:
+        return ImageFont.load_default(size=size)
+
+def make_drawings(count: int, seed: int = 0) -> List[Drawing]:
+    """ Returns the ground truth for count drawings, the same for a given seed """
+    rng = random.Random(seed)
+    drawings = []
+    for number in range(count):
+        drawings.append(Drawing(
+            lor=f'{rng.choice(LOR)}{rng.randint(100, 9999):03d}',
+            seq=f'{number + 1:03d}',
+            date=f'{rng.randint(1, 28):02d}/{rng.randint(1, 12):02d}/{rng.randint(2005, 2023)}',
+            route=rng.choice(ROUTES),
+            elr=rng.choice(ELRS),
+            miles=rng.randint(0, ELR_LENGTH - 1),
+            chains=rng.randint(0, 79)
+        ))
+    return drawings
+
+def table_cells(drawing: Drawing) -> List[List[str]]:
+    """ The Route/ELR/M Ch table of the drawing """
+    return [
+        ['Route', 'ELR', 'Mileage'],
+        [drawing.route, drawing.elr, 'Location'],
+        ['Description', 'Code', 'M Ch'],
+        ['Signal', drawing.elr, f'{drawing.miles} {drawing.chains:02d}']
+    ]
+
+def text_items(drawing: Drawing) -> List[Tuple[int, int, int, str]]:
+    """ Returns (left, top, font size, text) for every piece of text on the drawing """
+    items = []
+    for row, values in enumerate(table_cells(drawing)):
+        for column, value in enumerate(values):
+            left = TABLE_LEFT + sum(COLUMN_WIDTHS[:column])
+            items.append((left + 15, TABLE_TOP + row * ROW_HEIGHT + 18, 30, value))
+
+    top = int(SIZE[1] * rip.TITLE_BLOCK[0].top)
+    for left, caption, text in [
+            (120, 'LOR', drawing.lor),
+            (600, 'Seq', drawing.seq),
+            (1000, 'Date', drawing.date)
+        ]:
+        items.append((left, top + 20, 26, caption))
+        items.append((left, top + 70, 40, text))
+    return items
+
+def render(drawing: Drawing, skew: float = 0.0) -> Image.Image:
+    """ Render the drawing: route table at the top, title block along the
+    bottom, rotated by skew degrees as a misaligned scan would be """
+    image = Image.new('RGB', SIZE, 'white')
+    draw = ImageDraw.Draw(image)
+    width, height = SIZE
+
+    for row in range(len(table_cells(drawing))):
+        left = TABLE_LEFT
+        for column_width in COLUMN_WIDTHS:
+            top = TABLE_TOP + row * ROW_HEIGHT
+            draw.rectangle(
+                [left, top, left + column_width, top + ROW_HEIGHT], outline='black', width=3
+            )
+            left += column_width
+
+    draw.line([(120, 600), (width - 120, 600)], fill='black', width=6)
+    for left in range(220, width - 120, 240):
+        draw.line([(left, 570), (left, 630)], fill='black', width=4)
+
+    top = int(height * rip.TITLE_BLOCK[0].top)
+    draw.rectangle([20, top, width - 20, height - 20], outline='black', width=4)
+    for left, top, size, text in text_items(drawing):
+        draw.text((left, top), text, fill='black', font=font(size))
+    if skew:
+        return image.rotate(skew, resample=Image.BICUBIC, fillcolor='white')
+    return image
+
+def write_pdf(drawings: List[Drawing], path: str, text_layer: bool = False) -> None:
+    """ Pack one rendered drawing per page into the PDF, with text_layer
+    the drawing text is also written as invisible text, as an OCR'd PDF """
+    doc = fitz.open()
+    for drawing in drawings:
+        buffer = io.BytesIO()
+        render(drawing).save(buffer, format='PNG')
+        page = doc.new_page(width=PAGE_SIZE[0], height=PAGE_SIZE[1])
+        page.insert_image(page.rect, stream=buffer.getvalue())
+        if not text_layer:
+            continue
+        scale = PAGE_SIZE[0] / SIZE[0]
+        for left, top, size, text in text_items(drawing):
+            page.insert_text(
+                (left * scale, (top + size) * scale), text, fontsize=size * scale, render_mode=3
+            )
+    doc.save(path, deflate=True)
+    doc.close()
+
+def write_mileposts(path: str, seed: int = 0) -> None:
+    """ Write a GeoPackage of straight ELRs with a post every POST_INTERVAL miles """
+    import geopandas as gpd
+    from shapely.geometry import Point
+
+    rng = random.Random(seed)
+    records = []
+    for elr in ELRS:
+        east, north = rng.uniform(300000, 500000), rng.uniform(150000, 450000)
+        bearing = rng.uniform(-1, 1), rng.uniform(-1, 1)
+        scale = METRES_PER_MILE / (bearing[0] ** 2 + bearing[1] ** 2) ** 0.5
+        for step in range(int(ELR_LENGTH / POST_INTERVAL) + 1):
+            value = step * POST_INTERVAL
+            records.append({
+                'ELR': elr,
+                'VALUE': value,
+                'geometry': Point(
+                    east + bearing[0] * scale * value, north + bearing[1] * scale * value
+                )
+            })
+    gpd.GeoDataFrame(records, crs=CRS).to_file(path, driver='GPKG')
+
+def generate(folder: str, count: int, seed: int = 0, text_layer: bool = False) -> List[Drawing]:
+    """ Write synthetic.pdf and mileposts.gpkg to the folder, returns the ground truth """
+    os.makedirs(folder, exist_ok=True)
+    drawings = make_drawings(count, seed)
+    write_pdf(drawings, os.path.join(folder, 'synthetic.pdf'), text_layer)
+    write_mileposts(os.path.join(folder, 'mileposts.gpkg'), seed)
+    return drawings
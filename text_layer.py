@@ -0,0 +1,88 @@
+""" Read the Table A fields from the PDF text layer, bypassing OCR where
+the page carries vector text or an embedded OCR layer """
+
+# pylint: disable=E0401
+
+from collections import namedtuple
+from typing import Dict, List, Union
+import fitz
+
+Word = namedtuple('Word', 'x0, y0, x1, y1, text')
+
+ROUTE_HEADER = 'Route'
+ELR_HEADER = 'ELR'
+MILEAGE_HEADER = 'MCh'
+LINE_GAP = 2.0
+
+def page_words(page: fitz.Page) -> List[Word]:
+    """ Returns the words on the page in reading order """
+    return [Word(*word[:5]) for word in page.get_text('words', sort=True)]
+
+def as_tokens(words: List[Word]) -> List[tuple]:
+    """ The words as detailed OCR results, text layer words have full confidence """
+    return [
+        (
+            [[word.x0, word.y0], [word.x1, word.y0], [word.x1, word.y1], [word.x0, word.y1]],
+            word.text,
+            1.0
+        )
+        for word in words
+    ]
+
+def group_lines(words: List[Word]) -> List[List[Word]]:
+    """ Group the words into lines, top to bottom and left to right """
+    lines = []
+    for word in sorted(words, key=lambda word: (word.y0, word.x0)):
+        middle = (word.y0 + word.y1) / 2
+        if lines and lines[-1][0].y0 <= middle <= lines[-1][0].y1:
+            lines[-1].append(word)
+        else:
+            lines.append([word])
+    return [sorted(line, key=lambda word: word.x0) for line in lines]
+
+def find_header(lines: List[List[Word]], header: str) -> Union[tuple, None]:
+    """ Returns (line index, left, right) of the column under the header,
+    which may be split over two words, e.g. 'M' 'Ch'. Columns are taken
+    as left aligned, running from the header to the next header """
+    for index, line in enumerate(lines):
+        for pos, word in enumerate(line):
+            for span in (1, 2):
+                text = ''.join(each.text for each in line[pos:pos + span]).replace('.', '')
+                if text != header:
+                    continue
+                margin = word.y1 - word.y0
+                right = line[pos + span].x0 if pos + span < len(line) else float('inf')
+                return index, word.x0 - margin, right - margin
+    return None
+
+def column_below(lines: List[List[Word]], header: str, rows: int = 1) -> Union[str, None]:
+    """ The text of the column under the header, up to rows lines, stopping
+    at a gap wider than LINE_GAP line heights """
+    found = find_header(lines, header)
+    if not found:
+        return None
+    index, left, right = found
+
+    values = []
+    previous = lines[index][0]
+    for line in lines[index + 1:]:
+        cell = [word for word in line if left < (word.x0 + word.x1) / 2 < right]
+        if not cell:
+            continue
+        height = previous.y1 - previous.y0
+        if cell[0].y0 - previous.y1 > LINE_GAP * height:
+            break
+        values.append(' '.join(word.text for word in cell))
+        previous = cell[0]
+        if len(values) >= rows:
+            break
+    return '\n'.join(values) or None
+
+def read_table(words: List[Word]) -> Dict[str, Union[str, None]]:
+    """ The raw description, mileage and ELR values, keyed as data_extract.extract_values """
+    lines = group_lines(words)
+    return {
+        'raw_desc': column_below(lines, ROUTE_HEADER),
+        'raw_mileages': column_below(lines, MILEAGE_HEADER, rows=len(lines)),
+        'raw_elr': column_below(lines, ELR_HEADER)
+    }
@@ -0,0 +1,88 @@
+""" Title block fields read from plain or detailed OCR results """
+
+from collections import namedtuple
+import re
+from typing import Iterator, Tuple
+
+TitleFields = namedtuple('TitleFields', 'label, lor, seq, updated')
+
+LOR = ['CY', 'EA', 'GW', 'LN', 'MD', 'NW', 'NZ', 'SC', 'SO', 'SW', 'XR']
+VALID_SEQ = re.compile("^[O0-9]{3}$")
+ALT_VALID_SEQ = re.compile("^[O0-9]{3}")
+VALID_DATE = re.compile("[0-9]{2}/[0-9]{2}/[0-9]{4}")
+TO_DIGITS = str.maketrans('OoIlS', '00115')
+TO_LETTERS = str.maketrans('015', 'OIS')
+CONFUSION_PENALTY = 0.9
+PARTIAL_PENALTY = 0.5
+
+def create_regex() -> str:
+    """ Create the regex search string """
+    return f"^({'|'.join(LOR)}){{1}}[O0-9]{{3,4}}$"
+
+VALID_LOR = re.compile(create_regex())
+
+def tokens(values: list) -> Iterator[Tuple[str, float]]:
+    """ Yields (text, confidence) for plain or detailed (bbox, text, conf) results """
+    for value in values:
+        if isinstance(value, str):
+            yield value.strip(), 1.0
+        else:
+            yield str(value[1]).strip(), float(value[2])
+
+def corrected(text: str, table: dict) -> Tuple[str, float]:
+    """ Returns the text with OCR confusions replaced and the confidence penalty """
+    fixed = text.translate(table)
+    return fixed, 1.0 if fixed == text else CONFUSION_PENALTY
+
+def has_digit(text: str) -> bool:
+    """ Returns True where the text holds at least one digit as read """
+    return any(char.isdigit() for char in text)
+
+def parse_fields(values: list) -> TitleFields:
+    """ Classify the tokens in a single pass, keeping the most confident
+    candidate for each field
+
+    O/0, I/1 and S/5 confusions are corrected, letters in the LOR prefix
+    and digits elsewhere, at a small confidence penalty. A sequence must
+    hold at least one real digit, so words like 'SOS' are not read as
+    sequences. A sequence found
+    only as the start of a longer token is used only where there is no
+    exact match, whatever the confidences.
+    """
+    label = False
+    best = {
+        'lor': (0.0, None), 'seq': (0.0, None), 'partial_seq': (0.0, None), 'updated': (0.0, None)
+    }
+
+    def offer(field: str, score: float, value: str) -> None:
+        if score > best[field][0]:
+            best[field] = (score, value)
+
+    for text, conf in tokens(values):
+        length = len(text)
+        if length == 3:
+            if text.translate(TO_LETTERS) == 'LOR':
+                label = True
+                continue
+            fixed, penalty = corrected(text, TO_DIGITS)
+            if VALID_SEQ.match(fixed) and has_digit(text):
+                offer('seq', conf * penalty, fixed)
+                continue
+        if length in (5, 6):
+            prefix, penalty = corrected(text[:2], TO_LETTERS)
+            number, number_penalty = corrected(text[2:], TO_DIGITS)
+            if VALID_LOR.match(prefix + number):
+                offer('lor', conf * penalty * number_penalty, prefix + number)
+                continue
+        if length == 10:
+            fixed, penalty = corrected(text, TO_DIGITS)
+            match = VALID_DATE.match(fixed)
+            if match:
+                offer('updated', conf * penalty, match.group())
+                continue
+        fixed, penalty = corrected(text[:3], TO_DIGITS)
+        if ALT_VALID_SEQ.match(fixed) and has_digit(text[:3]):
+            offer('partial_seq', conf * penalty * PARTIAL_PENALTY, fixed)
+
+    seq = best['seq'][1] or best['partial_seq'][1]
+    return TitleFields(label, best['lor'][1], seq, best['updated'][1])
@@ -1,69 +1,119 @@
-""" Update failed meta information """
+""" Update failed meta information
 
-from typing import List, Union
+Records with Undefined fields are corrected by hand, or with --auto by
+inference from the adjacent sequences in the same LOR. Confident fills
+go straight to the corrected file, the rest are queued in review.tsv
+for the interactive step (--source review.tsv). In the queue each field
+needing review reads Undefined, followed by ?suggestion where --auto
+has one, e.g. an ELR unknown to the milepost index.
+"""
+
+# pylint: disable=C0415
+
+from typing import Callable, Dict, List, Tuple, Union
 from collections import namedtuple
-import csv
+import argparse
+import math
 import os
+import re
+
+import record_writer
+from record_writer import COLUMNS, RecordWriter, parquet_path, read_frame
 
 OUTPUT_DIR = '.'
 TSV = 'output.tsv'
 CORRECTED_FILE = os.path.join(OUTPUT_DIR, 'corrected.tsv')
+REVIEW_FILE = os.path.join(OUTPUT_DIR, 'review.tsv')
+AUDIT_FILE = os.path.join(OUTPUT_DIR, 'auto_corrections.tsv')
+AUDIT_COLUMNS = ['file', 'field', 'old', 'new', 'confidence']
 FULL_PATH = os.path.join(OUTPUT_DIR, TSV)
+MP_GEO = os.path.join(OUTPUT_DIR, 'mileposts.gpkg')
 NOT_SET_KW = 'Undefined'
+SUGGESTED = '?'
 Record = namedtuple('Record', 'file, lor, seq, elr, m, ch, yds, desc')
 processed = []
 
-def import_records() -> list:
-    """ Parse the records from the TSV file """
+YARDS_PER_MILE = 1760
+YARDS_PER_CHAIN = 22
+# Fill confidences: both neighbours agree, or only the nearest is usable,
+# less GAP_PENALTY for each sequence number between it and the record.
+# An interpolated mileage also loses SPAN_PENALTY for each mile between
+# the neighbours, so a guess across a wide span goes for review
+MIN_CONFIDENCE = 0.8
+BOTH_AGREE = 0.95
+INTERPOLATED = 0.9
+NEAREST = 0.7
+GAP_PENALTY = 0.05
+SPAN_PENALTY = 0.02
+ELR_CORRECTED = 0.85
+OUT_OF_RANGE = 0.5
+UNVALIDATED = 0.9
 
-    with open(TSV, '+r', encoding='utf-8') as tsv:
-        reader = csv.reader(tsv, delimiter='\t')
-        return list(reader)
+def as_text(column: str, value) -> str:
+    """ A record value as read from the TSV, nulls from the Parquet file
+    are Undefined and chains keep their two digits """
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return NOT_SET_KW
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    if column == 'ch' and isinstance(value, int):
+        return f'{value:02d}'
+    return str(value)
+
+def import_records(path: str = TSV) -> list:
+    """ Parse the records from the TSV file, or its Parquet file where current """
+    frame = read_frame(path, COLUMNS[:8], dtype=str)
+    return [
+        [as_text(column, value) for column, value in zip(COLUMNS, row)]
+        for row in frame.itertuples(index=False)
+    ]
 
 def parse_records(rows: list) -> List[Record]:
     """ Return list of Records """
     return [Record(*row) for row in rows]
 
-def prompt(name: str, default: Union[str, None] = None, rec: bool = False) -> Union[str, None]:
-    """ Standard prompt for data correction """
-
-    if not rec:
-        print(f'\t{name} not specified')
+def prompt(name: str, default: Union[str, None] = None) -> Union[str, None]:
+    """ Standard prompt for data correction, repeated until a value is accepted """
 
-    if default and NOT_SET_KW not in default:
-        resp = input(f'\t\tUse "{default}" (Y/N)? ')
-        if resp.strip() == 'Y':
-            return default
-
-    next_prompt = input(f'\t\tEnter the value for {name}: ')
-    value = prompt(name, next_prompt, True)
-    return value
+    print(f'\t{name} not specified')
+    while True:
+        if default and NOT_SET_KW not in default:
+            resp = input(f'\t\tUse "{default}" (Y/N)? ')
+            if resp.strip() == 'Y':
+                return default
+        default = input(f'\t\tEnter the value for {name}: ')
 
+def suggestion(value: str) -> Union[str, None]:
+    """ The value --auto suggested for a field queued for review, if any """
+    if NOT_SET_KW in value and SUGGESTED in value:
+        return value.split(SUGGESTED, 1)[1] or None
+    return None
 
 def correct_undef(record: Record, cur_elr: str, cur_desc: str):
-    """ Prompt for value correction where needed """
+    """ Prompt for value correction where needed, offering the suggestion
+    from --auto first """
 
     print()
     print(record)
 
     elr = record.elr
     if NOT_SET_KW in elr:
-        elr = prompt('ELR', cur_elr)
+        elr = prompt('ELR', suggestion(elr) or cur_elr)
         cur_elr = elr
 
     desc = record.desc
     if NOT_SET_KW in desc:
-        desc = prompt('Description', cur_desc)
+        desc = prompt('Description', suggestion(desc) or cur_desc)
         cur_desc = desc
 
     miles = record.m
     if NOT_SET_KW in miles:
-        miles = prompt('Miles', miles)
+        miles = prompt('Miles', suggestion(miles))
 
     chains = record.ch
     yards = record.yds
     if NOT_SET_KW in chains:
-        chains = prompt('Chains', chains)
+        chains = prompt('Chains', suggestion(chains))
         yards = int(chains) * 22
 
     return Record(
@@ -77,33 +127,248 @@ def correct_undef(record: Record, cur_elr: str, cur_desc: str):
         desc
     )
 
+def is_set(value: str) -> bool:
+    """ Returns True if the field holds a value """
+    return NOT_SET_KW not in str(value)
+
+def has_mileage(record: Record) -> bool:
+    """ Returns True if the miles, chains and yards are all numbers """
+    return all(str(value).isdigit() for value in (record.m, record.ch, record.yds))
+
+def seq_number(record: Record) -> int:
+    """ The sequence as a number, a suffix such as _2 is ignored """
+    found = re.match(r'\d+', record.seq)
+    return int(found.group()) if found else 0
+
+def gap(record: Record, other: Record) -> int:
+    """ The number of sequences between the two records """
+    return max(abs(seq_number(record) - seq_number(other)) - 1, 0)
+
+def group_by_lor(records: List[Record]) -> Dict[str, List[Record]]:
+    """ The records of each LOR in sequence order """
+    groups: Dict[str, List[Record]] = {}
+    for record in records:
+        groups.setdefault(record.lor, []).append(record)
+    for group in groups.values():
+        group.sort(key=seq_number)
+    return groups
+
+def neighbours(group: List[Record], pos: int, usable: Callable) -> Tuple[Record, Record]:
+    """ The nearest usable records before and after the position, None where there is none """
+    before = next((group[i] for i in range(pos - 1, -1, -1) if usable(group[i])), None)
+    after = next((group[i] for i in range(pos + 1, len(group)) if usable(group[i])), None)
+    return before, after
+
+def load_ranges(gpkg: str = MP_GEO) -> Union[Dict[str, Tuple[float, float]], None]:
+    """ The milepost range in miles of each ELR, None without the GeoPackage """
+    if not os.path.isfile(gpkg):
+        print(f'{gpkg} not found, ELRs and mileages are not validated')
+        return None
+    from mp_index import MilepostIndex
+    index = MilepostIndex(gpkg)
+    return {
+        elr: (float(index.values[rows].min()), float(index.values[rows].max()))
+        for elr, rows in index.slices.items()
+    }
+
+def fill_value(
+        group: List[Record],
+        pos: int,
+        field: str,
+        usable: Callable = None
+    ) -> Tuple[str, float]:
+    """ The field value from the adjacent sequences and its confidence """
+    record = group[pos]
+    usable = usable or (lambda other: is_set(getattr(other, field)))
+    before, after = neighbours(group, pos, usable)
+    if before and after and getattr(before, field) == getattr(after, field):
+        penalty = GAP_PENALTY * (gap(record, before) + gap(record, after))
+        return getattr(before, field), BOTH_AGREE - penalty
+    found = [other for other in (before, after) if other]
+    if not found:
+        return getattr(record, field), 0.0
+    nearest = min(found, key=lambda other: gap(record, other))
+    return getattr(nearest, field), NEAREST - GAP_PENALTY * gap(record, nearest)
+
+def fill_elr(
+        group: List[Record],
+        pos: int,
+        ranges: Union[Dict[str, tuple], None]
+    ) -> Tuple[str, float]:
+    """ The ELR and its confidence, a missing ELR is taken from the adjacent
+    sequences, a set ELR unknown to the milepost index is corrected where
+    a valid neighbour differs by a single misread character """
+    record = group[pos]
+    if not is_set(record.elr):
+        if ranges is None:
+            elr, confidence = fill_value(group, pos, 'elr')
+            return elr, confidence * UNVALIDATED
+        return fill_value(group, pos, 'elr', lambda other: other.elr in ranges)
+
+    if ranges is None or record.elr in ranges:
+        return record.elr, 1.0
+    for other in neighbours(group, pos, lambda other: other.elr in ranges):
+        if other and len(other.elr) == len(record.elr) and sum(
+                first != second for first, second in zip(other.elr, record.elr)) == 1:
+            return other.elr, ELR_CORRECTED
+    return record.elr, 0.0
+
+def fill_mileage(
+        group: List[Record],
+        pos: int,
+        elr: str,
+        ranges: Union[Dict[str, tuple], None]
+    ) -> Tuple[Tuple[str, str, int], float]:
+    """ The miles, chains and yards interpolated between the adjacent
+    sequences on the same ELR, and the confidence """
+    record = group[pos]
+    before, after = neighbours(
+        group, pos, lambda other: other.elr == elr and has_mileage(other)
+    )
+    if not before and not after:
+        return (record.m, record.ch, record.yds), 0.0
+
+    def total(other: Record) -> int:
+        return int(other.m) * YARDS_PER_MILE + int(other.yds)
+
+    if before and after:
+        span = seq_number(after) - seq_number(before)
+        share = (seq_number(record) - seq_number(before)) / span if span else 0.5
+        yards = total(before) + share * (total(after) - total(before))
+        confidence = BOTH_AGREE if total(before) == total(after) else INTERPOLATED
+        confidence -= GAP_PENALTY * max(span - 2, 0)
+        confidence -= SPAN_PENALTY * abs(total(after) - total(before)) / YARDS_PER_MILE
+        confidence = max(confidence, 0.0)
+    else:
+        nearest = before or after
+        yards = total(nearest)
+        confidence = NEAREST - GAP_PENALTY * gap(record, nearest)
+
+    miles, chains = divmod(round(yards / YARDS_PER_CHAIN), YARDS_PER_MILE // YARDS_PER_CHAIN)
+    if str(record.m).isdigit() and int(record.m) != miles:
+        confidence = min(confidence, OUT_OF_RANGE)
+    if ranges is None:
+        confidence *= UNVALIDATED
+    elif elr in ranges:
+        start, end = ranges[elr]
+        if not start <= miles + chains / 80 <= end:
+            confidence = min(confidence, OUT_OF_RANGE)
+    return (str(miles), f'{chains:02d}', chains * YARDS_PER_CHAIN), confidence
+
+def infer(
+        records: List[Record],
+        ranges: Union[Dict[str, tuple], None] = None
+    ) -> Dict[str, Tuple[Record, float, list]]:
+    """ Fill the missing fields of each record from its LOR neighbours
+
+    Returns the corrected record, its confidence, the lowest of its
+    fields, and the (field, old, new, confidence) changes by file name.
+    """
+    results = {}
+    for group in group_by_lor(records).values():
+        for pos, record in enumerate(group):
+            changes = []
+            elr, score = fill_elr(group, pos, ranges)
+            if score < 1:
+                changes.append(('elr', record.elr, elr, score))
+
+            desc = record.desc
+            if not is_set(desc):
+                desc, score = fill_value(group, pos, 'desc')
+                changes.append(('desc', record.desc, desc, score))
+
+            mileage = (record.m, record.ch, record.yds)
+            if not has_mileage(record):
+                mileage, score = fill_mileage(group, pos, elr, ranges)
+                old = ' '.join(str(value) for value in (record.m, record.ch, record.yds))
+                changes.append(('mileage', old, ' '.join(str(value) for value in mileage), score))
+
+            corrected = Record(record.file, record.lor, record.seq, elr, *mileage, desc)
+            confidence = min((change[3] for change in changes), default=1.0)
+            results[record.file] = (corrected, confidence, changes)
+    return results
+
+def review_record(result: Record, changes: list, min_confidence: float) -> Record:
+    """ The record for the review queue: confident fills are kept and each
+    field filled below min_confidence is reset to Undefined, followed by
+    ?suggestion where one was found """
+    values = result._asdict()
+    for field, _, _, score in changes:
+        if score >= min_confidence:
+            continue
+        for name in ['m', 'ch', 'yds'] if field == 'mileage' else [field]:
+            value = str(values[name])
+            values[name] = f'{NOT_SET_KW}{SUGGESTED}{value}' if is_set(value) else NOT_SET_KW
+    return Record(**values)
+
+def auto_correct(
+        source: str = TSV,
+        min_confidence: float = MIN_CONFIDENCE,
+        gpkg: str = MP_GEO
+    ) -> Tuple[int, int]:
+    """ Write the records filled with at least min_confidence to the
+    corrected file and queue the others for review, see review_record.
+    Every fill is logged to the audit file. Returns the counts written and queued """
+    records = parse_records(import_records(source))
+    results = infer(records, load_ranges(gpkg))
+
+    for path in [CORRECTED_FILE, parquet_path(CORRECTED_FILE), REVIEW_FILE, AUDIT_FILE]:
+        if os.path.isfile(path):
+            os.remove(path)
+
+    # The review queue and audit log are for reading, only the corrected
+    # records are written to Parquet
+    written = queued = 0
+    with RecordWriter(CORRECTED_FILE) as corrected, \
+            RecordWriter(REVIEW_FILE, parquet=False) as review, \
+            RecordWriter(AUDIT_FILE, columns=AUDIT_COLUMNS, parquet=False) as audit:
+        for record in records:
+            result, confidence, changes = results[record.file]
+            audit.write_many((record.file, *change[:3], round(change[3], 2)) for change in changes)
+            if confidence >= min_confidence:
+                corrected.write(result)
+                written += 1
+            else:
+                review.write(review_record(result, changes, min_confidence))
+                queued += 1
+
+    print(f'{written} records written to {CORRECTED_FILE}, {queued} queued in {REVIEW_FILE}')
+    return written, queued
+
 def write_to_tsv() -> None:
     """ Output to the correct file/format """
 
-    for record in processed:
-        to_write: str = (
-            f'{record.file}\t',
-            f'{record.lor}\t',
-            f'{record.seq}\t',
-            f'{record.elr}\t',
-            f'{record.m}\t',
-            f'{record.ch}\t',
-            f'{record.yds}\t',
-            f'{record.desc}\n'
-        )
-        with open(CORRECTED_FILE, 'a', encoding='utf-8') as file:
-            file.write(''.join(to_write))
-
-def main():
+    with RecordWriter(CORRECTED_FILE) as writer:
+        writer.write_many(processed)
+
+def main(argv: Union[List[str], None] = None):
     """ Entrypoint """
-    records = parse_records(import_records())
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--auto', action='store_true',
+                        help='fill the records from their LOR neighbours, replacing the '
+                        'corrected file, and queue the low confidence ones for review')
+    parser.add_argument('--source', default=TSV,
+                        help=f'records to correct, e.g. {REVIEW_FILE} after --auto')
+    parser.add_argument('--min-confidence', type=float, default=MIN_CONFIDENCE,
+                        help='lowest confidence written without review')
+    parser.add_argument('--parquet', action='store_true',
+                        help='also write typed output to corrected.parquet')
+    args = parser.parse_args(argv)
+
+    record_writer.WRITE_PARQUET = args.parquet
+
+    if args.auto:
+        auto_correct(args.source, args.min_confidence)
+        return
+
+    records = parse_records(import_records(args.source))
 
     cur_elr: str = 'Undefined'
     cur_desc: str = 'Undefined'
 
     for record in records:
 
-        if NOT_SET_KW not in record:
+        if not any(NOT_SET_KW in str(value) for value in record):
             processed.append(record)
             cur_elr = record.elr
             cur_desc = record.desc